@@ -1,84 +1,321 @@
-from flask import Flask, render_template,request,jsonify
-import xarray as xr
-import json
-from mlguess.keras.models import CategoricalDNN
-from keras.models import load_model
-from bridgescaler import load_scaler
+import time
+BOOT_STARTED = time.perf_counter()
+
+from flask import Flask,request,jsonify,send_from_directory,send_file
+import os
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from werkzeug.security import safe_join
 import numpy as np
 import pandas as pd
+from gridindex import GridIndex
+from datacache import DatasetCache
+from profilestore import ProfileStore, PROFILE_VARS, POINT_VARS, store_paths
+from batching import MicroBatcher
+from profilemetrics import calc_profile_metrics, format_metrics, METRIC_VARS, HEIGHTS
+from resultcache import ResultCache
+from timing import StageTimer
+from ingest import RunIndex, runs_index, parse_name
+from memstats import memory_usage
+from binformat import pack_profile, PROFILE_MIMETYPE
+from regionstats import RegionMasks, RegionTables, region_stats, PTYPES, THRESHOLDS
+from derived import DerivedStore, derived_paths, wet_bulb
 
 app = Flask(__name__,static_folder="")
 
-# Nearest neighbors dictionary (rounded to nearest 0.05 deg)
-# Tells which grid point to extract for every 0.05 deg increment
-with open('nn.json', 'r') as json_file:
-    loaded_dict = json.load(json_file)
+# Per-stage request timings, exposed at /metrics
+# PTYPE_TIMING=0 turns them off, PTYPE_SERVER_TIMING=1 adds Server-Timing headers,
+# PTYPE_METRICS_DIR sums the counters of all Gunicorn workers
+timer = StageTimer(enabled=os.environ.get("PTYPE_TIMING", "1") != "0",
+                   server_timing=os.environ.get("PTYPE_SERVER_TIMING") == "1",
+                   shared_dir=os.environ.get("PTYPE_METRICS_DIR"))
+timer.init_app(app)
+
+# Nearest grid point index (built with `python gridindex.py <any HRRR netcdf> gridindex`)
+# Memory-mapped, so it is shared between workers rather than copied into each one
+grid = GridIndex("gridindex")
 
 # Load model and scaler
-model = load_model("ptype_model_20240909.keras")
-scaler = load_scaler("ptype_scaler_20240909.json") 
-groups = scaler.groups_
-input_features = [x for y in groups for x in y]
+# Uses the pure NumPy export if present (`python npmodel.py export ...`) so workers don't import TensorFlow
+if os.path.exists("ptype_model_20240909.npz"):
+    from npmodel import NumpyModel
+    npmodel = NumpyModel("ptype_model_20240909.npz")
+    input_features = npmodel.features
+
+    # Scale and predict a batch of (n, 84) profiles, returns probabilities (n, 4) and uncertainty (n,)
+    def predict(rows):
+        with timer.stage("predict"):
+            return npmodel.predict(rows)
+
+else:
+    from mlguess.keras.models import CategoricalDNN
+    from keras.models import load_model
+    from bridgescaler import load_scaler
+    model = load_model("ptype_model_20240909.keras")
+    scaler = load_scaler("ptype_scaler_20240909.json")
+    groups = scaler.groups_
+    input_features = [x for y in groups for x in y]
+
+    # Scale and predict a batch of (n, 84) profiles, returns probabilities (n, 4) and uncertainty (n,)
+    def predict(rows):
+        with timer.stage("scale"):
+            transformed = scaler.transform(pd.DataFrame(rows, columns=input_features))
+        with timer.stage("predict"):
+            pred = model.predict(transformed,return_uncertainties=True)
+        return pred[0].numpy(), pred[1].numpy()[:,0]
+
+# Concurrent modSounding requests share one predict call
+batcher = MicroBatcher(predict, max_batch=64, max_wait=0.005)
+
+# Open netcdf handles and decoded ML fields, shared by all requests in this worker
+cache = DatasetCache(max_bytes=512 * 1024**2, max_files=32)
+
+# Point-optimized profile stores (built with `python profilestore.py data/*.nc`)
+store = ProfileStore()
+
+# Derived surface fields (wet bulb etc., built with `python derived.py data/*.nc` or by the ingest watcher)
+surface_store = DerivedStore()
+SURFACE_VARS = ["t2m", "d2m", "wb2m"]
+
+# Available runs index written by the ingest watcher (`python ingest.py data`)
+# Files it publishes get their ML fields decoded into this worker's cache before the first click
+def warm(paths):
+    for path in paths:
+        for var in POINT_VARS:
+            cache.field(path, var)
+
+runs = RunIndex("data", on_publish=warm)
+
+# Grid masks of /regionStats regions and per-file row integral images of the ML fields
+regions = RegionMasks(grid.latlon)
+region_tables = RegionTables(cache, max_bytes=256 * 1024**2)
+
+# Memoized /getCSV and /retrieveValue bodies per grid point
+# Set PTYPE_RESULT_CACHE to a SQLite path (e.g. /dev/shm/ptype_results.db) to share them between workers
+results = ResultCache(max_entries=20000, max_bytes=128 * 1024**2, shared_path=os.environ.get("PTYPE_RESULT_CACHE"))
+
+# Point responses only change when a run is regenerated, clients revalidate with the ETag after this
+RESULT_MAX_AGE = 3600
+
+# GeoJSON layers (and their .gz/.br siblings) written by scripts/layers.py --output-dir
+LAYER_DIR = os.path.abspath(os.environ.get("PTYPE_LAYER_DIR", "../frontend/public"))
+
+# Layer files are per run/forecast hour and never change once written
+LAYER_MAX_AGE = 365 * 24 * 3600
+
+# Vector tile pyramids written by scripts/layers.py --tiles (<layer>/<run>/<z>/<x>/<y>.pbf), by default
+# under <output-dir>/tiles
+TILE_DIR = os.path.abspath(os.environ.get("PTYPE_TILE_DIR", os.path.join(LAYER_DIR, "tiles")))
+
+# Tiles of a run/forecast hour never change once written, except when a run is regenerated
+TILE_MAX_AGE = 24 * 3600
+
+# Animation bundles are rewritten as forecast hours of their run arrive
+BUNDLE_MAX_AGE = 60
+
+# Content hashes of the most recently served layer files, with the (mtime, size) they were computed for
+# so a rewritten file gets a new ETag
+layer_etags = OrderedDict()
+layer_etags_lock = threading.Lock()
+LAYER_ETAG_ENTRIES = 20000
+
+# Reads the forecast hours of a run in parallel for /timeSeries
+pool = ThreadPoolExecutor(max_workers=8)
+
+# Import and model load time, and the process that did it (the Gunicorn master with preload_app)
+BOOT_SECONDS = time.perf_counter() - BOOT_STARTED
+BOOT_PID = os.getpid()
+
+# Start the run index watcher in each worker (after any fork)
+@app.before_request
+def watch_runs():
+    runs.watch()
+
+# Netcdf path prefix for the date/initialization of a request
+def run_prefix(data):
+    date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+    datetime_object = datetime.strptime(data['date'], date_format)
+    datetime_object_formatted = datetime_object.strftime("%Y-%m-%d") + "_" + data['initialization'][:2] + "00"
+    return f"data/MILES_ptype_hrrr_{datetime_object_formatted}"
+
+# Netcdf for the date/initialization/forecast hour of a request
+def netcdf_path(data):
+    return run_prefix(data) + "_f" + str(data['forecastHour']).zfill(2) + ".nc"
+
+# Profile and ML probabilities at a grid point
+# One read from the profile store, falling back to the netcdf if the store is missing or stale
+def read_profile(path, x, y):
+    with timer.stage("store"):
+        profile = store.read_point(path, x, y)
+    if profile is not None:
+        return profile
+
+    with timer.stage("open"):
+        mydata = cache.dataset(path)
+    with timer.stage("slice"):
+        profile = {"agl": mydata['heightAboveGround'].values}
+        for var in PROFILE_VARS:
+            profile[var] = mydata[var][0,:,x,y].values
+        for var in POINT_VARS:
+            profile[var] = cache.field(path, var)[x,y]
+    return profile
+
+# 2 m temperature, dewpoint and wet bulb in C at a grid point
+# From the derived-field sidecar, or computed from the netcdf point values if it is missing or stale
+# None for netcdfs without the surface fields (compress.py keeps only the profiles and ML fields)
+def read_surface(path, x, y):
+    with timer.stage("derived"):
+        values = surface_store.read_point(path, x, y, SURFACE_VARS)
+    if values is None:
+        with timer.stage("open"):
+            mydata = cache.dataset(path)
+        if 't2m' not in mydata or 'd2m' not in mydata:
+            return None
+        with timer.stage("slice"):
+            t = float(mydata['t2m'][0,x,y].values) - 273.15
+            td = float(mydata['d2m'][0,x,y].values) - 273.15
+        values = {"t2m": t, "d2m": td, "wb2m": float(wet_bulb(t, td))}
+    return {var: round(value, 2) for var, value in values.items()}
+
+# ML probabilities (and optionally surface temperature and wet bulb in C, None if the netcdf has no
+# surface fields) at a grid point
+def read_probabilities(path, x, y, surface=False):
+    profile = store.read_point(path, x, y)
+    if profile is None:
+        profile = {var: cache.field(path, var)[x,y] for var in POINT_VARS}
+    values = [float(profile[var]) for var in POINT_VARS]
+    if surface:
+        values += [None, None]
+        surface_values = read_surface(path, x, y)
+        if surface_values is not None:
+            values[-2:] = [surface_values["t2m"], surface_values["wb2m"]]
+    return values
+
+# Request parameters from the JSON body, or from the query string for cacheable GET requests
+def request_data():
+    return request.get_json(silent=True) or request.args.to_dict()
+
+# Files a point response is computed from, memoized responses are dropped once any of them is rewritten
+def source_signature(path):
+    signature = []
+    for source in (path, store_paths(path)[0], derived_paths(path)[0]):
+        try:
+            st = os.stat(source)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+# Response for a grid point, built once per (endpoint, representation, netcdf, grid point) and then served from
+# the result cache. build returns a Response or the body bytes
+# GET responses carry an ETag and Cache-Control so nginx and browsers can cache them too
+def memoized(endpoint, path, x, y, build, mimetype='application/json'):
+    key = (endpoint, mimetype, path, int(x), int(y))
+    with timer.stage("result_cache"):
+        signature = source_signature(path)
+        body = results.get(key, signature)
+    if body is None:
+        body = build()
+        if not isinstance(body, bytes):
+            body = body.get_data()
+        results.put(key, signature, body)
+
+    response = app.response_class(body, mimetype=mimetype)
+    if endpoint == 'getCSV':
+        response.headers['Vary'] = 'Accept'
+    if request.method == 'GET':
+        response.set_etag(hashlib.sha1(body).hexdigest()[:20])
+        response.headers['Cache-Control'] = f"public, max-age={RESULT_MAX_AGE}"
+        response.make_conditional(request)
+    return response
+
+# Precomputed skew-T stats at a grid point, or None for netcdfs without them
+# From the profile store record if it has them, otherwise read for the single point (not decoded in full)
+def read_metrics(path, x, y, profile):
+    if all(var in profile for var in METRIC_VARS):
+        return format_metrics({var: profile[var] for var in METRIC_VARS})
+    mydata = cache.dataset(path)
+    if not all(var in mydata for var in METRIC_VARS):
+        return None
+    return format_metrics({var: mydata[var][0,x,y].values for var in METRIC_VARS})
 
 # Retrieve profile and predictions for chosen lat/lon + date/time
 @app.route('/getCSV',methods=['GET','POST'])
 def getCSV():
 
-    # JSON data from request
-    data = request.get_json()
+    # JSON data from request (or query string for GET)
+    data = request_data()
     if data:
 
-        # Coordinates, initialization, forecast hour
+        # Coordinates and netcdf for initialization, forecast hour
         lat = data['lat']
         lon = data['lon']
-        date = data['date']
-        initialization = data['initialization']
-        forecasthour = data['forecastHour']
-
-        # Format it and extract
-        date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-        datetime_object = datetime.strptime(date, date_format)
-        year = datetime_object.year
-        month = datetime_object.month
-        day = datetime_object.day
-        datetime_object_formatted = datetime_object.strftime("%Y-%m-%d") + "_" + initialization[:2] + "00" + "_f" + str(forecasthour).zfill(2)
-        coord = f"({float(lat):.5g},{float(lon):.5g})"
-
-        # Should change this but gets grid points of coordinates
-        (x,y) = eval(loaded_dict[coord])
-
-        # Opens relevant netcdf and gets profile at calculated grid points
-        mydata = xr.open_dataset(f"data/MILES_ptype_hrrr_{datetime_object_formatted}.nc")
-        agl = mydata['heightAboveGround'].values
-        presreturn = mydata['isobaricInhPa_h'][0,:,x,y].values
-        treturn = mydata['t_h'][0,:,x,y].values
-        dptreturn = mydata['dpt_h'][0,:,x,y].values
-        ureturn = mydata['u_h'][0,:,x,y].values
-        vreturn = mydata['v_h'][0,:,x,y].values
-
-        rain = mydata['ML_rain'][0,x,y].values
-        snow = mydata['ML_snow'][0,x,y].values
-        icep = mydata['ML_icep'][0,x,y].values
-        frzr = mydata['ML_frzr'][0,x,y].values
-        uncertainty = mydata['ML_u'][0,x,y].values
-        rainhrrr = mydata['ML_rain'][0,x,y].values
-        snowhrrr = mydata['ML_snow'][0,x,y].values
-        icephrrr = mydata['ML_icep'][0,x,y].values
-        frzrhrrr = mydata['ML_frzr'][0,x,y].values
-        mydatasub = mydata.isel(time=0, x=y, y=x)
-
-        # Calculate skew-T stats
-        metrics = calc_profile_metrics(treturn)
+        path = netcdf_path(data)
 
-        mydata.close()
+        # Gets grid points of coordinates
+        with timer.stage("lookup"):
+            point = grid.lookup(float(lat), float(lon))
+        if point is None:
+            return jsonify({"error": "Coordinates outside of HRRR domain"}), 400
+        (x,y) = point
 
-        # Returns data to front end
-        return jsonify({"message": "Data received", "temperature": treturn.tolist(), "dewpoint": dptreturn.tolist(), "pressure": presreturn.tolist(), "rain": rain.tolist(), "snow": snow.tolist(), "icep": icep.tolist(), "frzr": frzr.tolist(), "rainhrrr": rainhrrr.tolist(), "snowhrrr": snowhrrr.tolist(), "icephrrr": icephrrr.tolist(), "frzrhrrr": frzrhrrr.tolist(), "uwind": ureturn.tolist(), "vwind": vreturn.tolist(), "metrics": metrics, "agl":agl.tolist(), "uncertainty":uncertainty.tolist()})  # Return a JSON response
+        # Packed float32 instead of JSON for clients that ask for it
+        if request.accept_mimetypes.best_match(['application/json', PROFILE_MIMETYPE]) == PROFILE_MIMETYPE:
+            return memoized('getCSV', path, x, y, lambda: profile_binary(path, x, y), PROFILE_MIMETYPE)
+        return memoized('getCSV', path, x, y, lambda: profile_response(path, x, y))
 
     else:
         return jsonify({"error": "No data received"}), 400  # Return an error response
 
+# Profile, predictions and skew-T stats at a grid point
+def profile_response(path, x, y):
+
+    # Gets profile at calculated grid points
+    profile = read_profile(path, x, y)
+    agl = profile['agl']
+    presreturn = profile['isobaricInhPa_h']
+    treturn = profile['t_h']
+    dptreturn = profile['dpt_h']
+    ureturn = profile['u_h']
+    vreturn = profile['v_h']
+
+    rain = profile['ML_rain']
+    snow = profile['ML_snow']
+    icep = profile['ML_icep']
+    frzr = profile['ML_frzr']
+    uncertainty = profile['ML_u']
+    rainhrrr = rain
+    snowhrrr = snow
+    icephrrr = icep
+    frzrhrrr = frzr
+
+    # Skew-T stats, precomputed in the netcdf by profilemetrics.py if available
+    with timer.stage("metrics"):
+        skewt_stats = read_metrics(path, x, y, profile)
+        if skewt_stats is None:
+            skewt_stats = calc_profile_metrics(treturn)
+
+    # 2 m temperature, dewpoint and wet bulb (null if the netcdf has no surface fields)
+    surface = read_surface(path, x, y)
+
+    # Returns data to front end
+    with timer.stage("serialize"):
+        return jsonify({"message": "Data received", "temperature": treturn.tolist(), "dewpoint": dptreturn.tolist(), "pressure": presreturn.tolist(), "rain": rain.tolist(), "snow": snow.tolist(), "icep": icep.tolist(), "frzr": frzr.tolist(), "rainhrrr": rainhrrr.tolist(), "snowhrrr": snowhrrr.tolist(), "icephrrr": icephrrr.tolist(), "frzrhrrr": frzrhrrr.tolist(), "uwind": ureturn.tolist(), "vwind": vreturn.tolist(), "metrics": skewt_stats, "agl":agl.tolist(), "uncertainty":uncertainty.tolist(), "surface": surface})  # Return a JSON response
+
+# Same as profile_response, packed by binformat
+def profile_binary(path, x, y):
+    profile = read_profile(path, x, y)
+    with timer.stage("metrics"):
+        skewt_stats = read_metrics(path, x, y, profile)
+        if skewt_stats is None:
+            skewt_stats = calc_profile_metrics(profile['t_h'])
+    with timer.stage("serialize"):
+        return pack_profile(profile, skewt_stats, METRIC_VARS)
+
 # Function if skew-T is modified
 @app.route('/modSounding',methods=['GET','POST'])
 def modSounding():
@@ -91,119 +328,340 @@ def modSounding():
         dpt = data['dewpoint']
         uwind = data['uwind']
         vwind = data['vwind']
-        groups = scaler.groups_
-        input_features = [x for y in groups for x in y]
 
-        # Reformat and scale
+        # Reformat and make predictions (scaled in the batcher)
         tempanddpt = np.concatenate((temp,dpt,uwind,vwind))
-        tempanddpt = tempanddpt.reshape((1,84)) 
-        transformed = scaler.transform(pd.DataFrame(tempanddpt, columns=input_features))
-        
-        # Make predictions
-        pred = model.predict(transformed,return_uncertainties=True)
-        probs = pred[0].numpy()[0]
-        uncertainty = pred[1].numpy()[0][0]
+        tempanddpt = tempanddpt.reshape((1,84))
+        with timer.stage("batch"):
+            probs, uncertainty = batcher.submit(tempanddpt)
+        probs = probs[0]
+        uncertainty = uncertainty[0]
         rain = probs[0]
         snow = probs[1]
         icep = probs[2]
         frzr = probs[3]
 
         # Calculate skew-T stats
-        metrics = calc_profile_metrics(np.array(temp))
+        with timer.stage("metrics"):
+            skewt_stats = calc_profile_metrics(np.array(temp))
 
         # Return new predictions
-        return jsonify({"message": "Data received", "rain": rain.tolist(), "snow": snow.tolist(), "icep": icep.tolist(), "frzr": frzr.tolist(), "uncertainty":uncertainty.tolist(), "metrics":metrics})  # Return a JSON response
+        with timer.stage("serialize"):
+            return jsonify({"message": "Data received", "rain": rain.tolist(), "snow": snow.tolist(), "icep": icep.tolist(), "frzr": frzr.tolist(), "uncertainty":uncertainty.tolist(), "metrics":skewt_stats})  # Return a JSON response
 
     else:
         return jsonify({"error": "No data received"}), 400  # Return an error response
 
+# Many modified skew-Ts in one request
+@app.route('/modSoundingBatch',methods=['POST'])
+def modSoundingBatch():
+
+    data = request.get_json()
+    if data and data.get('profiles'):
+
+        # One row per profile
+        profiles = data['profiles']
+        rows = np.array([np.concatenate((p['temperature'],p['dewpoint'],p['uwind'],p['vwind'])) for p in profiles]).reshape((-1,84))
+        with timer.stage("batch"):
+            probs, uncertainty = batcher.submit(rows)
+        with timer.stage("metrics"):
+            skewt_stats = [calc_profile_metrics(np.array(p['temperature'])) for p in profiles]
+
+        return jsonify({"message": "Data received", "rain": probs[:,0].tolist(), "snow": probs[:,1].tolist(), "icep": probs[:,2].tolist(), "frzr": probs[:,3].tolist(), "uncertainty": uncertainty.tolist(), "metrics": skewt_stats})
+
+    else:
+        return jsonify({"error": "No data received"}), 400
+
+# Largest number of perturbed profiles in one /modSoundingSweep request
+MAX_SWEEP = 1000
+
+# Offsets of a sweep, either a list or {"start", "stop", "step"} (stop included)
+def sweep_offsets(spec):
+    if isinstance(spec, dict):
+        start, stop, step = float(spec['start']), float(spec['stop']), float(spec['step'])
+        if step <= 0 or stop < start:
+            raise ValueError("Sweep needs start <= stop and a positive step")
+        if (stop - start) / step >= MAX_SWEEP:
+            raise ValueError(f"Sweeps need between 1 and {MAX_SWEEP} offsets")
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    if not isinstance(spec, list):
+        raise TypeError("Offsets must be a list or {start, stop, step}")
+    offsets = np.asarray(spec, dtype='float64')
+    if offsets.ndim != 1 or not np.isfinite(offsets).all():
+        raise ValueError("Offsets must be a flat list of numbers")
+    return offsets
+
+# Sensitivity of the predictions to a perturbation of one skew-T
+# Takes a profile plus {"variable": "temperature"|"dewpoint"|"both", "offsets": ..., "bottom": m, "top": m}
+# and predicts every offset (applied to the levels between bottom and top AGL, all levels by default) in one call
+@app.route('/modSoundingSweep',methods=['POST'])
+def modSoundingSweep():
+
+    data = request.get_json(silent=True)
+    if data and data.get('perturbation'):
+
+        # Base profile and perturbation spec
+        spec = data['perturbation']
+        variable = spec.get('variable', 'temperature')
+        if variable not in ('temperature', 'dewpoint', 'both'):
+            return jsonify({"error": "Perturbation variable must be temperature, dewpoint or both"}), 400
+        try:
+            offsets = sweep_offsets(spec['offsets'])
+            bottom, top = float(spec.get('bottom', HEIGHTS[0])), float(spec.get('top', HEIGHTS[-1]))
+        except (KeyError, TypeError, ValueError) as error:
+            return jsonify({"error": f"Invalid offsets: {error}"}), 400
+        if not 0 < len(offsets) <= MAX_SWEEP:
+            return jsonify({"error": f"Sweeps need between 1 and {MAX_SWEEP} offsets"}), 400
+        layer = (HEIGHTS >= bottom) & (HEIGHTS <= top)
+
+        # One row per offset, dewpoint kept at or below temperature
+        temp = np.array(data['temperature'], dtype='float64')
+        dpt = np.array(data['dewpoint'], dtype='float64')
+        shift = offsets[:,None] * layer[None,:]
+        temps = temp + shift if variable in ('temperature', 'both') else np.tile(temp, (len(offsets), 1))
+        dpts = dpt + shift if variable in ('dewpoint', 'both') else np.tile(dpt, (len(offsets), 1))
+        dpts = np.minimum(dpts, temps)
+        winds = np.tile(np.concatenate((data['uwind'], data['vwind'])), (len(offsets), 1))
+        rows = np.concatenate((temps, dpts, winds), axis=1)
+
+        with timer.stage("batch"):
+            probs, uncertainty = batcher.submit(rows)
+
+        with timer.stage("serialize"):
+            return jsonify({"message": "Data received", "offsets": offsets.tolist(), "rain": probs[:,0].tolist(), "snow": probs[:,1].tolist(), "icep": probs[:,2].tolist(), "frzr": probs[:,3].tolist(), "uncertainty": uncertainty.tolist()})
+
+    else:
+        return jsonify({"error": "No data received"}), 400
+
+# Batch size and queue wait statistics for tuning max_batch/max_wait
+@app.route('/batchStats',methods=['GET'])
+def batchStats():
+    return jsonify(batcher.stats())
+
 # Function for sampling values from map
 @app.route('/retrieveValue',methods=['GET','POST'])
 def retrieveValue():
-    data = request.get_json()
+    data = request_data()
 
     if data:
 
         # Need coordinates and time info from request
         lat = data['lat']
         lon = data['lon']
-        date = data['date']
-        initialization = data['initialization']
-        forecasthour = data['forecastHour']
-        date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-        datetime_object = datetime.strptime(date, date_format)
-        year = datetime_object.year
-        month = datetime_object.month
-        day = datetime_object.day
-        datetime_object_formatted = datetime_object.strftime("%Y-%m-%d") + "_" + initialization[:2] + "00" + "_f" + str(forecasthour).zfill(2)
-        coord = f"({float(lat):.5g},{float(lon):.5g})"
+        path = netcdf_path(data)
 
         # Get gridpoints
-        (x,y) = eval(loaded_dict[coord])
-
-        # Read probabilities from netcdf
-        mydata = xr.open_dataset(f"data/MILES_ptype_hrrr_{datetime_object_formatted}.nc")
-        rain = mydata['ML_rain'][0,x,y].values
-        snow = mydata['ML_snow'][0,x,y].values
-        icep = mydata['ML_icep'][0,x,y].values
-        frzr = mydata['ML_frzr'][0,x,y].values
-        uncertainty = mydata['ML_u'][0,x,y].values
-        mydata.close()
-
-        # Return probabilities
+        with timer.stage("lookup"):
+            point = grid.lookup(float(lat), float(lon))
+        if point is None:
+            return jsonify({"error": "Coordinates outside of HRRR domain"}), 400
+        (x,y) = point
+        return memoized('retrieveValue', path, x, y, lambda: values_response(path, x, y))
+
+    else:
+        return jsonify({"error": "No data received"}), 400
+
+# ML probabilities at a grid point
+def values_response(path, x, y):
+
+    # Read probabilities from cached netcdf fields
+    with timer.stage("field"):
+        rain = cache.field(path, 'ML_rain')[x,y]
+        snow = cache.field(path, 'ML_snow')[x,y]
+        icep = cache.field(path, 'ML_icep')[x,y]
+        frzr = cache.field(path, 'ML_frzr')[x,y]
+        uncertainty = cache.field(path, 'ML_u')[x,y]
+
+    # Return probabilities
+    with timer.stage("serialize"):
         return jsonify({"message": "Data received", "rain": rain.tolist(), "snow": snow.tolist(), "icep": icep.tolist(), "frzr": frzr.tolist(), "uncertainty": uncertainty.tolist()})
 
-# Calculate skew-T stats
-def calc_profile_metrics(x, profile_var='t_h', resolution=250):
-    """ Given a vertical temperature profile, return area energy using the  
-    Bourgouin area method estimated with the trapezoidal method. 
-
-    Args:
-        ds (xr.Dataset): xarray dataset of the vertical profile of a single spatial point
-        profile_var (str): The name of the variable to use for calculations
-        resolution (int): Vertical spatial resolution of profile in meters. 
-    Returns:
-        Dict: Dictionary of statistics for elevated cold / warm layers
-    """
-    hgts = np.array([0,250,500,750,1000,1250,1500,1750,2000,2250,2500,2750,3000,3250,3500,3750,4000,4250,4500,4750,5000])
-
-    metrics = {}
-    warm = np.argwhere(x > 0).squeeze()    
-
-    # Check for warm nose
-    if warm.size == 0:
-        metrics['upper_nose_height_agl'] = 'N/A'
-        metrics['lower_nose_height_agl'] = 'N/A'
-        metrics['warm_nose_depth_m'] = 'N/A'
-        metrics['warm_nose_area'] = 'N/A'
-        metrics['cold_layer_depth_m'] = 'N/A'
-        metrics['cold_layer_area'] = 'N/A'
+# Ptype statistics over a region, e.g. {"bbox": [west, south, east, north], ...} or {"geometry": <GeoJSON>, ...}
+# plus date/initialization/forecastHour and optionally "thresholds" (probabilities, default THRESHOLDS)
+@app.route('/regionStats',methods=['POST'])
+def regionStats():
+    data = request.get_json(silent=True)
+
+    if data and (data.get('bbox') or data.get('geometry')):
+
+        # Netcdf and thresholds
+        path = netcdf_path(data)
+        if not os.path.exists(path):
+            return jsonify({"error": "No data for this run and forecast hour"}), 404
+        thresholds = [float(t) for t in data.get('thresholds', THRESHOLDS)]
+        if any(not 0 <= t <= 1 for t in thresholds):
+            return jsonify({"error": "Thresholds must be between 0 and 1"}), 400
+
+        # Grid points of the region (cached per geometry)
+        with timer.stage("mask"):
+            try:
+                mask = regions.mask(data.get('geometry') or data['bbox'])
+            except (ValueError, KeyError, TypeError, IndexError) as error:
+                return jsonify({"error": f"Invalid region: {error}"}), 400
+
+        # Sums from the row integral images, maxima over the mask's points
+        with timer.stage("field"):
+            tables = region_tables.tables_for(path, source_signature(path))
+            fields = {'ML_' + p: cache.field(path, 'ML_' + p) for p in PTYPES}
+        with timer.stage("stats"):
+            stats = region_stats(tables, fields, mask, thresholds)
+
+        return jsonify(dict({"message": "Data received"}, **stats))
+
     else:
-        cold = np.argwhere(np.where(x < 0)[0] < warm.min()).squeeze()
-        if cold.size == 0:
-            metrics['upper_nose_height_agl'] = 'N/A'
-            metrics['lower_nose_height_agl'] = 'N/A'
-            metrics['warm_nose_depth_m'] = 'N/A'
-            metrics['warm_nose_area'] = 'N/A'
-            metrics['cold_layer_depth_m'] = 'N/A'
-            metrics['cold_layer_area'] = 'N/A' 
-        else:
-            print(warm)
-            top_nose = warm.max()
-            bottom_nose = warm.min()
-            warm_nose_depth = (top_nose - bottom_nose) * resolution
-            metrics['upper_nose_height_agl'] = str(hgts[top_nose])
-            metrics['lower_nose_height_agl'] = str(hgts[bottom_nose])
-            metrics['warm_nose_depth_m'] = str(int(warm_nose_depth))
-            metrics['warm_nose_area'] = str(int(np.abs(np.trapz(x[warm], dx=len(warm) * resolution))))
-            top_cold = cold.max()
-            bottom_cold = cold.min()
-            cold_layer_depth = str(int((top_cold - bottom_cold) * resolution))
-            metrics['cold_layer_depth_m'] = str(int(cold_layer_depth))
-            metrics['cold_layer_area'] = str(int(np.abs(np.trapz(x[cold], dx=len(cold) * resolution))))
-
-    return metrics
+        return jsonify({"error": "No data received"}), 400
+
+# Probabilities at a point for every available forecast hour of a run
+@app.route('/timeSeries',methods=['POST'])
+def timeSeries():
+    data = request.get_json()
 
+    if data:
+
+        # Coordinates and run from request, surface temperature only if asked for (null where a netcdf has none)
+        lat = data['lat']
+        lon = data['lon']
+        surface = bool(data.get('surface', False))
+        with timer.stage("lookup"):
+            point = grid.lookup(float(lat), float(lon))
+        if point is None:
+            return jsonify({"error": "Coordinates outside of HRRR domain"}), 400
+        (x,y) = point
+
+        # Forecast hours on disk for this run
+        paths = sorted(glob.glob(run_prefix(data) + "_f[0-9][0-9].nc"))
+        hours = [int(path[-5:-3]) for path in paths]
+        if not paths:
+            return jsonify({"error": "No forecast hours available for this run"}), 404
+
+        # One row per forecast hour, read concurrently through the cache
+        with timer.stage("field"):
+            rows = np.array(list(pool.map(timer.bind(lambda path: read_probabilities(path, x, y, surface)), paths)))
+
+        # Return one array per variable
+        response = {"message": "Data received", "forecastHour": hours, "rain": rows[:,0].tolist(), "snow": rows[:,1].tolist(), "icep": rows[:,2].tolist(), "frzr": rows[:,3].tolist(), "uncertainty": rows[:,4].tolist()}
+        if surface:
+            response["t2m"] = rows[:,5].tolist()
+            response["wb2m"] = rows[:,6].tolist()
+        return jsonify(response)
+
+    else:
+        return jsonify({"error": "No data received"}), 400
+
+# One vector tile of a layer, e.g. /tiles/evi_rain/2024-04-30_0000_f01/6/15/24.pbf
+@app.route('/tiles/<layer>/<run>/<int:z>/<int:x>/<int:y>.pbf',methods=['GET'])
+def tiles(layer, run, z, x, y):
+    path = f"{layer}/{run}/{z}/{x}/{y}.pbf"
+    fullpath = safe_join(TILE_DIR, path)
+    if fullpath is None:
+        return jsonify({"error": "Invalid tile path"}), 404
+
+    # Pyramids are moved into place whole, so a missing run directory is an unknown (or not yet written) run
+    if not os.path.isdir(os.path.join(TILE_DIR, layer, run)):
+        return jsonify({"error": "Tiles not found"}), 404
+
+    # Tiles without any geometry are not written, answer with an empty (still cacheable) response
+    if not os.path.exists(fullpath):
+        response = app.response_class(status=204)
+        response.headers['Cache-Control'] = f"public, max-age={TILE_MAX_AGE}"
+        return response
+
+    response = send_from_directory(TILE_DIR, path, mimetype='application/x-protobuf', max_age=TILE_MAX_AGE)
+    response.headers['Cache-Control'] = f"public, max-age={TILE_MAX_AGE}"
+    return response
+
+# Strong ETag from the content hash of a file
+def content_etag(path):
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with layer_etags_lock:
+        entry = layer_etags.get(path)
+        if entry is not None and entry[0] == signature:
+            layer_etags.move_to_end(path)
+            return entry[1]
+    with open(path, 'rb') as f:
+        etag = hashlib.sha1(f.read()).hexdigest()[:20]
+    with layer_etags_lock:
+        layer_etags[path] = (signature, etag)
+        layer_etags.move_to_end(path)
+        while len(layer_etags) > LAYER_ETAG_ENTRIES:
+            layer_etags.popitem(last=False)
+    return etag
+
+# GeoJSON layer, e.g. /hrrr_t/MILES_ptype_hrrr_2024-04-30_0000_f01_t.geojson
+# Sends the smallest precompressed variant the client accepts instead of compressing on the fly
+@app.route('/<layer>/<name>.geojson',methods=['GET'])
+def layerFile(layer, name):
+    path = safe_join(LAYER_DIR, layer, name + ".geojson")
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Layer not found"}), 404
+
+    # Precompressed siblings that are accepted, current and actually smaller
+    variant, encoding = path, None
+    for ext, enc in ((".br", "br"), (".gz", "gzip")):
+        candidate = path + ext
+        if request.accept_encodings[enc] and os.path.isfile(candidate) \
+                and os.path.getmtime(candidate) >= os.path.getmtime(path) \
+                and os.path.getsize(candidate) < os.path.getsize(variant):
+            variant, encoding = candidate, enc
+
+    # Each representation has its own strong ETag
+    etag = content_etag(path) + ("-" + encoding if encoding else "")
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = send_file(variant, mimetype='application/json', etag=False, conditional=False, max_age=LAYER_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f"public, max-age={LAYER_MAX_AGE}, immutable"
+    return response
+
+# Animation bundle of a run/layer, e.g. /hrrr_t/MILES_ptype_hrrr_2024-04-30_0000_t.bundle
+# Clients read the header, then fetch forecast hours with Range requests (If-Range against the ETag
+# guards against a bundle rewritten in between)
+@app.route('/<layer>/<name>.bundle',methods=['GET'])
+def layerBundle(layer, name):
+    path = safe_join(LAYER_DIR, layer, name + ".bundle")
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Bundle not found"}), 404
+
+    response = send_file(path, mimetype='application/octet-stream', etag=content_etag(path), conditional=True,
+                         max_age=BUNDLE_MAX_AGE)
+    response.headers['Cache-Control'] = f"public, max-age={BUNDLE_MAX_AGE}"
+    return response
+
+# Runs and forecast hours that can be requested, newest run first
+# Without an ingest watcher, lists the netcdfs on disk (unvalidated)
+@app.route('/runs',methods=['GET'])
+def availableRuns():
+    index = runs.get()
+    if index is None:
+        index = runs_index([name for name in os.listdir("data") if parse_name(name)])
+    response = jsonify(index)
+    response.headers['Cache-Control'] = "public, max-age=30"
+    return response
+
+# Dataset cache hit/miss counters
+@app.route('/cacheStats',methods=['GET'])
+def cacheStats():
+    return jsonify(cache.stats())
+
+# Stage and request duration histograms in Prometheus text format
+@app.route('/metrics',methods=['GET'])
+def metrics():
+    return app.response_class(timer.render(), mimetype='text/plain; version=0.0.4')
+
+# Memory of this worker and whether it was forked from a preloaded master
+@app.route('/workerStats',methods=['GET'])
+def workerStats():
+    return jsonify(dict({"pid": os.getpid(), "preloaded": os.getpid() != BOOT_PID, "boot_s": BOOT_SECONDS}, **memory_usage()))
+
+# Result cache hit/miss counters
+@app.route('/resultStats',methods=['GET'])
+def resultStats():
+    return jsonify(results.stats())
 
 if __name__ == "__main__":
     app.run(debug=True, threaded=True)
@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# Micro-batching for model inference
+#
+# Concurrent requests (e.g. several users dragging skew-Ts) each put their input rows on a queue.
+# A single worker thread runs one vectorized scale + predict over everything queued (up to max_batch rows)
+# and hands each request its slice. It only holds a batch open, for up to max_wait seconds, while other
+# callers are in submit() but not yet in the batch; a lone request is predicted straight away.
+# Only helps with threaded workers (gunicorn --threads / gthread); with one thread per worker it
+# degrades to one batch per request with no added wait.
+
+# Upper bounds of the batch size histogram buckets
+BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+class MicroBatcher:
+    """ Collects rows from concurrent callers into batched predict_fn calls.
+
+    Args:
+        predict_fn (callable): Takes an (n, n_features) array, returns a tuple of arrays with n rows each
+        max_batch (int): Stop collecting once this many rows are queued
+        max_wait (float): Seconds to wait for the rows of concurrent callers after the first one arrives
+    """
+
+    def __init__(self, predict_fn, max_batch=64, max_wait=0.005):
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.pid = None
+        # Callers in submit() whose rows have not been predicted yet
+        self.inflight = 0
+        self.counters = {"requests": 0, "rows": 0, "batches": 0, "queue_wait_s": 0.0,
+                         "queue_wait_max_s": 0.0, "predict_s": 0.0}
+        self.histogram = [0] * (len(BATCH_BUCKETS) + 1)
+
+    def submit(self, rows):
+        """ Predict for rows, batched together with any concurrent callers.
+
+        Args:
+            rows (np.ndarray): (n, n_features) inputs
+        Returns:
+            Tuple: predict_fn outputs for these rows only
+        """
+        self._start()
+        with self.lock:
+            self.inflight += 1
+        item = {"rows": np.atleast_2d(rows), "queued": time.perf_counter(), "done": threading.Event()}
+        self.queue.put(item)
+        item["done"].wait()
+        if "error" in item:
+            raise item["error"]
+        return item["result"]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["mean_batch_size"] = stats["rows"] / stats["batches"] if stats["batches"] else 0.0
+            stats["mean_queue_wait_s"] = stats["queue_wait_s"] / stats["requests"] if stats["requests"] else 0.0
+            labels = [f"<={b}" for b in BATCH_BUCKETS] + [f">{BATCH_BUCKETS[-1]}"]
+            stats["batch_size_histogram"] = dict(zip(labels, self.histogram))
+            stats.update({"max_batch": self.max_batch, "max_wait_s": self.max_wait})
+        return stats
+
+    def _start(self):
+        # Started lazily (and again after a fork) so it runs in the worker, not the gunicorn master
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.inflight = 0
+                threading.Thread(target=self._run, daemon=True).start()
+                self.pid = os.getpid()
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            nrows = len(items[0]["rows"])
+            deadline = time.perf_counter() + self.max_wait
+            while nrows < self.max_batch:
+                # Nobody else is submitting: don't wait for rows that are not coming
+                with self.lock:
+                    if self.inflight <= len(items):
+                        break
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items.append(item)
+                nrows += len(item["rows"])
+            self._predict(items, nrows)
+
+    def _predict(self, items, nrows):
+        start = time.perf_counter()
+        try:
+            outputs = self.predict_fn(np.concatenate([item["rows"] for item in items]))
+            offset = 0
+            for item in items:
+                n = len(item["rows"])
+                item["result"] = tuple(output[offset:offset + n] for output in outputs)
+                offset += n
+        except Exception as error:
+            for item in items:
+                item["error"] = error
+        end = time.perf_counter()
+
+        with self.lock:
+            waits = [start - item["queued"] for item in items]
+            self.counters["requests"] += len(items)
+            self.counters["rows"] += nrows
+            self.counters["batches"] += 1
+            self.counters["queue_wait_s"] += sum(waits)
+            self.counters["queue_wait_max_s"] = max(self.counters["queue_wait_max_s"], max(waits))
+            self.counters["predict_s"] += end - start
+            self.histogram[int(np.searchsorted(BATCH_BUCKETS, nrows))] += 1
+            self.inflight -= len(items)
+
+        for item in items:
+            item["done"].set()
@@ -0,0 +1,478 @@
+import argparse
+import http.client
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+# Load benchmark for the backend on synthetic data
+#
+#   python benchmark.py synth bench --hours 3 [--layout compressed]
+#       writes bench/data/MILES_ptype_hrrr_2024-04-30_0000_fFF.nc with the real variable names and shapes
+#       (21 levels, 1059 x 1799 HRRR Lambert grid), bench/gridindex and a link to the model export.
+#       The full layout has every variable of the source netcdfs, the compressed layout only those
+#       scripts/compress.py keeps, like the files actually served
+#   python benchmark.py run bench --mix click=5,drag=3,scrub=2 --concurrency 8 --requests 2000 --output a.json
+#       drives the app in-process through the Flask test client, or with --gunicorn N through N local workers,
+#       and saves p50/p95/p99 latency per request type, throughput and peak RSS
+#   python benchmark.py compare a.json b.json
+#
+# Request types:
+#   click - /getCSV at a random grid point and forecast hour (map click)
+#   value - /retrieveValue at a random grid point and forecast hour (map sampling)
+#   drag  - /modSounding with a perturbed profile (skew-T drag)
+#   scrub - /getCSV at a fixed point per client, stepping through the forecast hours
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# HRRR grid: Lambert conformal, 3 km, true at 38.5 N, centered on 38.5 N 97.5 W
+HRRR_SHAPE = (1059, 1799)
+HRRR_DX = 3000.0
+HRRR_LAT0 = 38.5
+HRRR_LON0 = -97.5
+EARTH_RADIUS = 6371229.0
+
+AGL = np.arange(0, 5001, 250).astype('float64')
+
+RUN_DATE = "2024-04-30"
+RUN_INIT = "00"
+
+MODEL_FILES = ["ptype_model_20240909.npz", "ptype_model_20240909.keras", "ptype_scaler_20240909.json"]
+
+OPS = ["click", "value", "drag", "scrub"]
+
+# Variables kept by scripts/compress.py (its keepvars)
+COMPRESSED_VARS = ["t_h", "dpt_h", "u_h", "v_h", "isobaricInhPa_h", "ML_rain", "ML_snow", "ML_icep", "ML_frzr", "ML_u"]
+LAYOUTS = ["full", "compressed"]
+
+
+def hrrr_latlon(shape=HRRR_SHAPE, dx=HRRR_DX):
+    """ Latitude and longitude (0-360) of a Lambert conformal grid shaped like HRRR """
+    ny, nx = shape
+    phi0 = np.radians(HRRR_LAT0)
+    n = np.sin(phi0)
+    F = np.cos(phi0) * np.tan(np.pi / 4 + phi0 / 2)**n / n
+    rho0 = EARTH_RADIUS * F / np.tan(np.pi / 4 + phi0 / 2)**n
+
+    x = (np.arange(nx) - (nx - 1) / 2) * dx
+    y = (np.arange(ny) - (ny - 1) / 2) * dx
+    x, y = np.meshgrid(x, y)
+    rho = np.hypot(x, rho0 - y)
+    theta = np.arctan2(x, rho0 - y)
+    lat = np.degrees(2 * np.arctan((EARTH_RADIUS * F / rho)**(1 / n)) - np.pi / 2)
+    lon = (HRRR_LON0 + np.degrees(theta / n)) % 360
+    return lat, lon
+
+
+def smooth_field(rng, shape, scale=1.0, waves=4):
+    """ Random large-scale pattern (sum of plane waves) in about [-scale, scale] """
+    ny, nx = shape
+    y, x = np.ogrid[0:1:ny * 1j, 0:1:nx * 1j]
+    field = np.zeros(shape, dtype='float32')
+    for _ in range(waves):
+        ky, kx = rng.uniform(0.5, 4, 2)
+        phase = rng.uniform(0, 2 * np.pi)
+        field += (np.sin(2 * np.pi * (ky * y + kx * x) + phase) / waves).astype('float32')
+    return scale * field
+
+
+def synthetic_dataset(shape, hour, seed=0):
+    """ One forecast hour with the variables and dims of the MILES_ptype_hrrr netcdfs """
+    import xarray as xr
+
+    rng = np.random.default_rng(seed + hour)
+    ny, nx = shape
+    lat, lon = hrrr_latlon(shape)
+    agl = AGL[:, None, None]
+
+    # Surface temperature decreasing northward, with a warm nose (elevated melting layer) over part of the grid
+    t_sfc = (25 - 0.8 * (lat - 25) + smooth_field(rng, shape, 6)).astype('float32')
+    nose = np.maximum(smooth_field(rng, shape, 8), 0)
+    t = t_sfc - 6.5e-3 * agl + nose * np.exp(-((agl - 1500) / 500)**2)
+    dpt = t - 1 - np.abs(smooth_field(rng, shape, 6))
+    u = 5 + smooth_field(rng, shape, 10) + 4e-3 * agl
+    v = smooth_field(rng, shape, 10) + 2e-3 * agl
+    p_sfc = 1013 + smooth_field(rng, shape, 15) - 0.1 * np.maximum(lat - 40, 0)
+    p = p_sfc * np.exp(-agl / 8000)
+
+    # Probabilities from a softmax of four patterns, and HRRR categorical precipitation
+    logits = np.stack([smooth_field(rng, shape, 3) for _ in range(4)])
+    probs = np.exp(logits) / np.exp(logits).sum(axis=0)
+    precip = smooth_field(rng, shape, 1) > 0.2
+    categorical = [(precip & (probs.argmax(axis=0) == i)).astype('float32') for i in range(4)]
+
+    def profile(values):
+        return (('time', 'heightAboveGround', 'y', 'x'), np.round(values, 1).astype('float32')[None])
+
+    def field(values, decimals=2):
+        return (('time', 'y', 'x'), np.round(values, decimals).astype('float32')[None])
+
+    return xr.Dataset({
+        't_h': profile(t), 'dpt_h': profile(dpt), 'u_h': profile(u), 'v_h': profile(v), 'isobaricInhPa_h': profile(p),
+        'ML_rain': field(probs[0], 4), 'ML_snow': field(probs[1], 4), 'ML_icep': field(probs[2], 4),
+        'ML_frzr': field(probs[3], 4), 'ML_u': field(np.abs(smooth_field(rng, shape, 0.9)), 4),
+        'crain': field(categorical[0]), 'csnow': field(categorical[1]),
+        'cicep': field(categorical[2]), 'cfrzr': field(categorical[3]),
+        't2m': field(t_sfc + 273.15), 'd2m': field(dpt[0] + 273.15),
+        'mslma': field(p_sfc * 100, 0), 'u10': field(u[0] * 0.7), 'v10': field(v[0] * 0.7),
+    }, coords={'time': [np.datetime64(f"{RUN_DATE}T{RUN_INIT}") + np.timedelta64(hour, 'h')],
+               'heightAboveGround': AGL, 'latitude': (('y', 'x'), lat), 'longitude': (('y', 'x'), lon)})
+
+
+def synth(workdir, hours=3, shape=HRRR_SHAPE, complevel=4, prepare=False, layout="full"):
+    """ Write synthetic netcdfs ('full' or 'compressed' variable layout), a grid index and model links into workdir """
+    from gridindex import build_index
+
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    paths = []
+    for hour in range(1, hours + 1):
+        path = os.path.join(workdir, "data", f"MILES_ptype_hrrr_{RUN_DATE}_{RUN_INIT}00_f{hour:02d}.nc")
+        start = time.perf_counter()
+        ds = synthetic_dataset(shape, hour)
+        if layout == "compressed":
+            ds = ds[COMPRESSED_VARS]
+        encoding = {var: {'zlib': True, 'complevel': complevel} for var in ds.data_vars} if complevel else None
+        ds.to_netcdf(path + '.tmp', encoding=encoding)
+        os.replace(path + '.tmp', path)
+        print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB in {time.perf_counter() - start:.1f} s")
+        paths.append(path)
+
+    build_index(paths[0], os.path.join(workdir, "gridindex"))
+
+    # Optionally precompute the skew-T stats and profile stores like a production data directory
+    if prepare:
+        from profilemetrics import add_metric_fields
+        from profilestore import build_store
+        for path in paths:
+            add_metric_fields(path)
+            build_store(path)
+
+    for name in MODEL_FILES:
+        source, link = os.path.join(BACKEND_DIR, name), os.path.join(workdir, name)
+        if os.path.exists(source) and not os.path.lexists(link):
+            os.symlink(source, link)
+
+
+def parse_mix(mix):
+    """ 'click=5,drag=3' -> (ops, cumulative weights) """
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise ValueError(f"Unknown request type {op}, expected one of {OPS}")
+        weights[op] = float(weight or 1)
+    ops = list(weights)
+    return ops, np.cumsum([weights[op] for op in ops]) / sum(weights.values())
+
+
+class Workload:
+    """ Generates the requests of one benchmark client """
+
+    def __init__(self, points, hours, profile, ops, cumulative, seed):
+        self.rng = np.random.default_rng(seed)
+        self.points = points
+        self.hours = hours
+        self.profile = profile
+        self.ops = ops
+        self.cumulative = cumulative
+        self.scrub_point = points[self.rng.integers(len(points))]
+        self.scrub_step = 0
+
+    def params(self, point, hour):
+        lat, lon = point
+        return {"lat": float(lat), "lon": float(lon), "date": f"{RUN_DATE}T00:00:00.000Z",
+                "initialization": f"{RUN_INIT}:00", "forecastHour": hour}
+
+    def next(self):
+        """ (request type, path, json body) """
+        op = self.ops[min(int(np.searchsorted(self.cumulative, self.rng.random(), side='right')), len(self.ops) - 1)]
+        if op == "click":
+            return op, "/getCSV", self.params(self.points[self.rng.integers(len(self.points))], int(self.rng.choice(self.hours)))
+        if op == "value":
+            return op, "/retrieveValue", self.params(self.points[self.rng.integers(len(self.points))], int(self.rng.choice(self.hours)))
+        if op == "scrub":
+            self.scrub_step += 1
+            return op, "/getCSV", self.params(self.scrub_point, self.hours[self.scrub_step % len(self.hours)])
+
+        # Drag one to three adjacent levels of the temperature or dewpoint profile
+        profile = {key: list(values) for key, values in self.profile.items()}
+        key = "temperature" if self.rng.random() < 0.7 else "dewpoint"
+        level = int(self.rng.integers(0, 19))
+        for i in range(level, level + int(self.rng.integers(1, 4))):
+            profile[key][i] += float(self.rng.normal(0, 2))
+        return op, "/modSounding", profile
+
+
+class TestClientTransport:
+    """ Requests through the Flask test client in this process """
+
+    def __init__(self, workdir):
+        os.chdir(workdir)
+        sys.path.insert(0, BACKEND_DIR)
+        import app
+        self.app = app.app
+
+    def client(self):
+        client = self.app.test_client()
+
+        def send(path, body):
+            if body is None:
+                response = client.get(path)
+            else:
+                response = client.post(path, json=body)
+            return response.status_code, response.get_json(silent=True)
+        return send
+
+    def peak_rss(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def close(self):
+        pass
+
+
+def process_tree_rss(pid):
+    """ Resident bytes of a process and its children (Linux /proc) """
+    total = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            if int(entry) != pid and ppid != pid:
+                continue
+            with open(f"/proc/{entry}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+class GunicornTransport:
+    """ Requests over HTTP to local Gunicorn workers, with the RSS of master + workers sampled in the background """
+
+    def __init__(self, workdir, workers, port, extra_args=""):
+        self.port = port
+        self.proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}",
+                                      "--chdir", os.path.abspath(workdir), "--pythonpath", BACKEND_DIR]
+                                     + extra_args.split() + ["app:app"])
+        deadline = time.time() + 300
+        while True:
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                conn.request("GET", "/batchStats")
+                if conn.getresponse().status == 200:
+                    break
+            except OSError:
+                pass
+            if self.proc.poll() is not None or time.time() > deadline:
+                raise RuntimeError("Gunicorn did not start")
+            time.sleep(0.5)
+
+        self.rss = 0
+        self.sampling = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while self.sampling:
+            self.rss = max(self.rss, process_tree_rss(self.proc.pid))
+            time.sleep(0.1)
+
+    def client(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+
+        def send(path, body):
+            if body is None:
+                conn.request("GET", path)
+            else:
+                conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = response.read()
+            try:
+                return response.status, json.loads(data)
+            except ValueError:
+                return response.status, None
+        return send
+
+    def peak_rss(self):
+        return self.rss
+
+    def close(self):
+        self.sampling = False
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def run(workdir, mix="click=5,drag=3,scrub=2", concurrency=8, requests=2000, warmup=50, points=500,
+        gunicorn=0, port=8765, gunicorn_args="", seed=0):
+    """ Drive the app with concurrent clients and return the report """
+    with open(os.path.join(workdir, "gridindex", "meta.json")) as f:
+        ny, nx = json.load(f)["grid_shape"]
+    latlon = np.load(os.path.join(workdir, "gridindex", "latlon.npy"), mmap_mode='r')
+    hours = sorted(int(name[-5:-3]) for name in os.listdir(os.path.join(workdir, "data"))
+                   if name.startswith("MILES_ptype_hrrr_") and name.endswith(".nc"))
+
+    # Fixed pool of interior grid points, so repeated clicks can hit the caches as in real use
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(ny // 10, ny - ny // 10, points)
+    cols = rng.integers(nx // 10, nx - nx // 10, points)
+    pool = [(float(latlon[0, r, c]), float((latlon[1, r, c] + 180) % 360 - 180)) for r, c in zip(rows, cols)]
+
+    start = time.perf_counter()
+    transport = GunicornTransport(workdir, gunicorn, port, gunicorn_args) if gunicorn else TestClientTransport(workdir)
+    startup = time.perf_counter() - start
+    try:
+        # Base skew-T for drags, from the first click
+        send = transport.client()
+        status, base = send("/getCSV", Workload(pool, hours, None, ["click"], [1.0], seed).params(pool[0], hours[0]))
+        if status != 200:
+            raise RuntimeError(f"/getCSV failed with {status}: {base}")
+        profile = {key: base[key] for key in ["temperature", "dewpoint", "uwind", "vwind"]}
+        ops, cumulative = parse_mix(mix)
+
+        latencies = {op: [] for op in ops}
+        errors = {op: 0 for op in ops}
+        counter = itertools.count()
+        lock = threading.Lock()
+
+        def client(index):
+            send = transport.client()
+            workload = Workload(pool, hours, profile, ops, cumulative, seed + 1 + index)
+            while True:
+                index = next(counter)
+                if index >= warmup + requests:
+                    break
+                op, path, body = workload.next()
+                t0 = time.perf_counter()
+                try:
+                    status, _ = send(path, body)
+                except Exception:
+                    status = None
+                elapsed = time.perf_counter() - t0
+                if index < warmup:
+                    continue
+                with lock:
+                    if status != 200:
+                        errors[op] += 1
+                    latencies[op].append(elapsed)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - t0
+
+        report = {"config": {"mix": mix, "concurrency": concurrency, "requests": requests, "warmup": warmup,
+                             "points": points, "hours": hours, "grid": [ny, nx],
+                             "transport": f"gunicorn x{gunicorn}" if gunicorn else "test client",
+                             "commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+                  "startup_s": startup, "wall_s": wall, "throughput_rps": (warmup + requests) / wall,
+                  "peak_rss_mb": transport.peak_rss() / 1e6, "ops": {}}
+        for op in ops:
+            values = np.array(latencies[op])
+            if not len(values):
+                continue
+            report["ops"][op] = {"count": int(len(values)), "errors": errors[op],
+                                 "mean_ms": float(values.mean() * 1e3),
+                                 "p50_ms": float(np.percentile(values, 50) * 1e3),
+                                 "p95_ms": float(np.percentile(values, 95) * 1e3),
+                                 "p99_ms": float(np.percentile(values, 99) * 1e3)}
+
+        # Cache and batching counters of the (last answering) worker
+        for name in ["cacheStats", "resultStats", "batchStats"]:
+            status, stats = send("/" + name, None)
+            if status == 200:
+                report[name] = stats
+        return report
+    finally:
+        transport.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(report):
+    config = report["config"]
+    print(f"{config['transport']}, concurrency {config['concurrency']}, mix {config['mix']}: "
+          f"{report['throughput_rps']:.1f} req/s, peak RSS {report['peak_rss_mb']:.0f} MB, startup {report['startup_s']:.1f} s")
+    for op, stats in report["ops"].items():
+        print(f"  {op:6s} n={stats['count']:6d} errors={stats['errors']:4d}  p50 {stats['p50_ms']:8.2f} ms  "
+              f"p95 {stats['p95_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms")
+
+
+def compare(paths):
+    """ Print latency percentiles and throughput of saved runs side by side, relative to the first """
+    reports = [json.load(open(path)) for path in paths]
+    base = reports[0]
+    for path, report in zip(paths, reports):
+        print(f"{path}: {report['config']['commit']} {report['config']['transport']}, "
+              f"{report['throughput_rps']:.1f} req/s ({report['throughput_rps'] / base['throughput_rps']:.2f}x), "
+              f"peak RSS {report['peak_rss_mb']:.0f} MB")
+        for op, stats in report["ops"].items():
+            ref = base["ops"].get(op)
+            ratios = "  ".join(f"{p} {stats[p]:8.2f} ms ({stats[p] / ref[p]:.2f}x)" if ref else f"{p} {stats[p]:8.2f} ms"
+                               for p in ["p50_ms", "p95_ms", "p99_ms"])
+            print(f"  {op:6s} {ratios}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend load benchmark on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_synth = commands.add_parser("synth", help="Write synthetic netcdfs and a grid index")
+    parser_synth.add_argument("workdir")
+    parser_synth.add_argument("--hours", type=int, default=3)
+    parser_synth.add_argument("--shape", type=int, nargs=2, default=list(HRRR_SHAPE), metavar=("NY", "NX"))
+    parser_synth.add_argument("--complevel", type=int, default=4, help="zlib level, 0 for uncompressed")
+    parser_synth.add_argument("--layout", choices=LAYOUTS, default="full",
+                              help="Variables written: all, or only those compress.py keeps")
+    parser_synth.add_argument("--prepare", action="store_true", help="Also add skew-T stats and build profile stores")
+
+    parser_run = commands.add_parser("run", help="Drive the app and report latency, throughput and RSS")
+    parser_run.add_argument("workdir")
+    parser_run.add_argument("--mix", default="click=5,drag=3,scrub=2")
+    parser_run.add_argument("--concurrency", type=int, default=8)
+    parser_run.add_argument("--requests", type=int, default=2000)
+    parser_run.add_argument("--warmup", type=int, default=50)
+    parser_run.add_argument("--points", type=int, default=500, help="Distinct grid points clicked")
+    parser_run.add_argument("--gunicorn", type=int, default=0, metavar="WORKERS", help="Run through local Gunicorn workers")
+    parser_run.add_argument("--port", type=int, default=8765)
+    parser_run.add_argument("--gunicorn-args", default="", help="Extra Gunicorn arguments, e.g. '--threads 4'")
+    parser_run.add_argument("--seed", type=int, default=0)
+    parser_run.add_argument("--output", help="Save the report as JSON")
+
+    parser_compare = commands.add_parser("compare", help="Compare saved reports")
+    parser_compare.add_argument("reports", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        synth(args.workdir, args.hours, tuple(args.shape), args.complevel, args.prepare, args.layout)
+    elif args.command == "run":
+        output = os.path.abspath(args.output) if args.output else None
+        report = run(args.workdir, args.mix, args.concurrency, args.requests, args.warmup, args.points,
+                     args.gunicorn, args.port, args.gunicorn_args, args.seed)
+        print_report(report)
+        if output:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+    else:
+        compare(args.reports)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import struct
+import numpy as np
+
+# Compact binary /getCSV response, sent instead of JSON when the request's Accept header prefers PROFILE_MIMETYPE
+#
+# Little-endian, 12 byte header followed by float32 values:
+#   header   - magic b"PTYP", version (uint16), levels (uint16), scalars (uint16), metrics (uint16)
+#   profiles - PROFILE_ARRAYS, `levels` values each
+#   scalars  - SCALARS (ML probabilities and uncertainty)
+#   metrics  - METRIC_VARS in profilemetrics order, NaN where the JSON response has 'N/A'
+# The *hrrr keys of the JSON response duplicate the ML probabilities and are left out, as is its surface dict.
+# 560 bytes for the 21 level profiles, against 1.7 kB or more of JSON.
+
+PROFILE_MIMETYPE = "application/vnd.ptype.profile"
+
+MAGIC = b"PTYP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHH")
+
+# (response name, profile key) in buffer order
+PROFILE_ARRAYS = [("agl", "agl"), ("pressure", "isobaricInhPa_h"), ("temperature", "t_h"), ("dewpoint", "dpt_h"),
+                  ("uwind", "u_h"), ("vwind", "v_h")]
+SCALARS = [("rain", "ML_rain"), ("snow", "ML_snow"), ("icep", "ML_icep"), ("frzr", "ML_frzr"), ("uncertainty", "ML_u")]
+
+
+def pack_profile(profile, metrics, metric_vars):
+    """ Binary body from a read_profile dict and formatted skew-T stats """
+    nlev = len(profile["agl"])
+    values = np.empty(len(PROFILE_ARRAYS) * nlev + len(SCALARS) + len(metric_vars), dtype='<f4')
+    for i, (name, key) in enumerate(PROFILE_ARRAYS):
+        values[i * nlev:(i + 1) * nlev] = profile[key]
+    offset = len(PROFILE_ARRAYS) * nlev
+    values[offset:offset + len(SCALARS)] = [profile[key] for name, key in SCALARS]
+    offset += len(SCALARS)
+    values[offset:] = [np.nan if metrics[var] == 'N/A' else float(metrics[var]) for var in metric_vars]
+    return HEADER.pack(MAGIC, VERSION, nlev, len(SCALARS), len(metric_vars)) + values.tobytes()
+
+
+def unpack_profile(body, metric_vars):
+    """ Dict of arrays/floats from a binary body (the inverse of pack_profile, for clients and checks) """
+    magic, version, nlev, nscalars, nmetrics = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version 1 ptype profile")
+    values = np.frombuffer(body, dtype='<f4', offset=HEADER.size)
+    out = {name: values[i * nlev:(i + 1) * nlev] for i, (name, key) in enumerate(PROFILE_ARRAYS)}
+    offset = len(PROFILE_ARRAYS) * nlev
+    out.update({name: float(values[offset + i]) for i, (name, key) in enumerate(SCALARS[:nscalars])})
+    offset += nscalars
+    out["metrics"] = {var: float(values[offset + i]) for i, var in enumerate(metric_vars[:nmetrics])}
+    return out
@@ -0,0 +1,120 @@
+import os
+import threading
+from collections import OrderedDict
+import xarray as xr
+
+# Process-wide LRU cache of open NetCDF handles and decoded 2D fields
+#
+# Entries are keyed by file path (one file per run/forecast hour) and checked against the file's
+# mtime/size/inode on every access, so a file replaced on disk is reopened rather than served stale.
+# Eviction is by an approximate memory budget: decoded fields count their nbytes and open handles
+# count a fixed estimate of their HDF5 metadata/chunk cache.
+
+# Rough resident cost of an open NetCDF handle (metadata + HDF5 chunk cache)
+HANDLE_BYTES = 8 * 1024**2
+
+
+class DatasetCache:
+    """ Size-bounded LRU cache of xarray datasets and decoded fields.
+
+    Args:
+        max_bytes (int): Approximate memory budget for open handles and decoded fields
+        max_files (int): Maximum number of open datasets
+    """
+
+    def __init__(self, max_bytes=512 * 1024**2, max_files=32):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.datasets = OrderedDict()
+        self.fields = OrderedDict()
+        self.nbytes = 0
+        self.counters = {"dataset_hits": 0, "dataset_misses": 0, "field_hits": 0, "field_misses": 0,
+                         "evictions": 0, "invalidations": 0}
+
+    def dataset(self, path):
+        """ Open dataset for path, reusing a cached handle if the file has not changed """
+        signature = _signature(path)
+        with self.lock:
+            entry = self.datasets.get(path)
+            if entry is not None:
+                if entry[0] == signature:
+                    self.datasets.move_to_end(path)
+                    self.counters["dataset_hits"] += 1
+                    return entry[1]
+                self._invalidate(path)
+            self.counters["dataset_misses"] += 1
+
+        ds = xr.open_dataset(path)
+        with self.lock:
+            # Another thread may have opened it in the meantime
+            entry = self.datasets.get(path)
+            if entry is not None and entry[0] == signature:
+                ds.close()
+                return entry[1]
+            self.datasets[path] = (signature, ds)
+            self.nbytes += HANDLE_BYTES
+            self._evict()
+        return ds
+
+    def field(self, path, var):
+        """ Decoded first time step of var as a NumPy array, cached alongside the dataset """
+        ds = self.dataset(path)
+        key = (path, var)
+        with self.lock:
+            values = self.fields.get(key)
+            if values is not None:
+                self.fields.move_to_end(key)
+                self.counters["field_hits"] += 1
+                return values
+            self.counters["field_misses"] += 1
+
+        values = ds[var][0].values
+        values.setflags(write=False)
+        with self.lock:
+            if key not in self.fields and path in self.datasets:
+                self.fields[key] = values
+                self.nbytes += values.nbytes
+                self._evict()
+        return values
+
+    def invalidate(self, path):
+        """ Drop a file's handle and fields, e.g. after it has been rewritten """
+        with self.lock:
+            self._invalidate(path)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({"datasets": len(self.datasets), "fields": len(self.fields),
+                          "bytes": self.nbytes, "max_bytes": self.max_bytes})
+        return stats
+
+    def _invalidate(self, path):
+        if path in self.datasets:
+            self.counters["invalidations"] += 1
+            self._drop(path)
+
+    def _drop(self, path):
+        signature, ds = self.datasets.pop(path)
+        self.nbytes -= HANDLE_BYTES
+        for key in [key for key in self.fields if key[0] == path]:
+            self.nbytes -= self.fields.pop(key).nbytes
+        # xarray reopens lazily if a request still holds this handle
+        ds.close()
+
+    def _evict(self):
+        # Evict decoded fields first (cheap to rebuild), then least recently used handles
+        while self.nbytes > self.max_bytes and self.fields:
+            key, values = self.fields.popitem(last=False)
+            self.nbytes -= values.nbytes
+            self.counters["evictions"] += 1
+        while (self.nbytes > self.max_bytes or len(self.datasets) > self.max_files) and len(self.datasets) > 1:
+            self._drop(next(iter(self.datasets)))
+            self.counters["evictions"] += 1
+
+
+def _signature(path):
+    """ Identity of the file currently at path (raises FileNotFoundError if missing) """
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+from sidecar import SidecarReader, create_array, publish
+
+# Derived surface fields, computed once per netcdf
+#
+# Wet bulb temperature, the smoothed fields the surface contour layers are drawn from and the HRRR
+# precipitation type masks are written to a sidecar next to each netcdf
+# (MILES_ptype_hrrr_<run>.derived.npy + .derived.json), laid out as [field, y, x] in float16 so
+# scripts/layers.py reads whole fields and the backend reads single points from a memory map.
+#
+# The metadata records the SHA-1 of the netcdf the fields were computed from: a sidecar older than its
+# netcdf is reused (and touched) when the content is unchanged, and rebuilt otherwise.
+#
+#   t2m, d2m, wb2m         - 2 m temperature, dewpoint and wet bulb in C
+#   <var>_smooth           - gaussian_filter(sigma=3) of t2m, d2m, wb2m (C), mslma (Pa), u10, v10 (m/s) and ML_u
+#   precip                 - bit i set where HRRR reports PRECIP_VARS[i]
+
+DERIVED_VARS = ["t2m", "d2m", "wb2m", "t2m_smooth", "d2m_smooth", "wb2m_smooth", "mslma_smooth", "u10_smooth",
+                "v10_smooth", "ML_u_smooth", "precip"]
+
+# Netcdf variables the derived fields are computed from
+SOURCE_VARS = ["t2m", "d2m", "mslma", "u10", "v10", "ML_u", "crain", "csnow", "cicep", "cfrzr"]
+PRECIP_VARS = ["crain", "csnow", "cicep", "cfrzr"]
+
+# Subtracted before storing, so float16 keeps pressure to a few Pa
+OFFSETS = {"mslma_smooth": 101325.0}
+
+SIGMA = 3
+
+
+def derived_paths(nc_path):
+    """ (array, metadata) paths of the sidecar belonging to a netcdf """
+    base = nc_path[:-3] if nc_path.endswith('.nc') else nc_path
+    return base + '.derived.npy', base + '.derived.json'
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def relative_humidity(t, td):
+    """ Relative humidity in % from temperature and dewpoint in C (Bolton 1980 saturation vapor pressure) """
+    return 100 * np.exp(17.67 * td / (td + 243.5) - 17.67 * t / (t + 243.5))
+
+
+def wet_bulb(t, td):
+    """ Wet bulb temperature in C from temperature and dewpoint in C (Stull 2011), elementwise """
+    rh = relative_humidity(t, td)
+    return t * np.arctan(0.151977 * np.sqrt(rh + 8.313659)) + np.arctan(t + rh) - np.arctan(rh - 1.676331) \
+        + 0.00391838 * rh**1.5 * np.arctan(0.023101 * rh) - 4.686035
+
+
+def compute_derived(source):
+    """ Dict of DERIVED_VARS from a dict (or open dataset) of the first time step of SOURCE_VARS """
+    from scipy.ndimage import gaussian_filter
+
+    def field(var):
+        values = source[var]
+        values = values[0].values if hasattr(values, 'dims') else values
+        return values.astype('float32', copy=False)
+
+    out = {"t2m": field('t2m') - np.float32(273.15), "d2m": field('d2m') - np.float32(273.15)}
+    out["wb2m"] = wet_bulb(out["t2m"], out["d2m"])
+    for var in ["t2m", "d2m", "wb2m"]:
+        out[var + "_smooth"] = gaussian_filter(out[var], sigma=SIGMA)
+    for var in ["mslma", "u10", "v10", "ML_u"]:
+        out[var + "_smooth"] = gaussian_filter(field(var), sigma=SIGMA)
+    precip = np.zeros(out["t2m"].shape, dtype='uint8')
+    for bit, var in enumerate(PRECIP_VARS):
+        precip |= (field(var) != 0).astype('uint8') << bit
+    out["precip"] = precip
+    return out
+
+
+def write_derived(nc_path, derived, digest):
+    """ Write the sidecar for a netcdf from compute_derived output """
+    npy_path, json_path = derived_paths(nc_path)
+    ny, nx = derived["t2m"].shape
+
+    out = create_array(npy_path, 'float16', (len(DERIVED_VARS), ny, nx))
+    for i, var in enumerate(DERIVED_VARS):
+        out[i] = derived[var] - OFFSETS.get(var, 0)
+    out.flush()
+    del out
+    publish(npy_path, json_path, {"vars": DERIVED_VARS, "offsets": OFFSETS, "sha1": digest})
+
+
+def decode(arr, meta, var, index=Ellipsis):
+    """ One field (or point) of a sidecar, with its offset added back """
+    values = arr[meta['vars'].index(var)][index]
+    if var == "precip":
+        return np.asarray(values).astype('uint8')
+    return np.asarray(values, dtype='float32') + np.float32(meta['offsets'].get(var, 0))
+
+
+def _current(nc_path, digest=None):
+    """ (array, metadata) of an up to date sidecar, or None """
+    npy_path, json_path = derived_paths(nc_path)
+    try:
+        with open(json_path) as json_file:
+            meta = json.load(json_file)
+        if meta.get('vars') != DERIVED_VARS:
+            return None
+        if os.path.getmtime(npy_path) < os.path.getmtime(nc_path):
+            # Netcdf touched or copied but not changed
+            if meta.get('sha1') != (digest or file_hash(nc_path)):
+                return None
+            os.utime(npy_path)
+        return np.load(npy_path, mmap_mode='r'), meta
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def derived_fields(nc_path, source=None, digest=None):
+    """ DERIVED_VARS of a netcdf, read from its sidecar or computed and written to it.
+
+    Args:
+        nc_path (str): Netcdf
+        source (dict or xr.Dataset): Already decoded SOURCE_VARS or the open dataset, to avoid opening it again
+        digest (str): SHA-1 of the netcdf if already known
+    Returns:
+        Dict: Variable name to 2D array (float32, uint8 for precip)
+    """
+    current = _current(nc_path, digest)
+    if current is not None:
+        arr, meta = current
+        return {var: decode(arr, meta, var) for var in DERIVED_VARS}
+
+    if source is None:
+        import xarray as xr
+        with xr.open_dataset(nc_path) as ds:
+            derived = compute_derived({var: ds[var][0].values for var in SOURCE_VARS})
+    else:
+        derived = compute_derived(source)
+
+    # Read-only data directories still get the fields, just not the sidecar
+    try:
+        write_derived(nc_path, derived, digest or file_hash(nc_path))
+    except OSError as error:
+        print(f"derived fields of {nc_path} not saved: {error}")
+    return derived
+
+
+class DerivedStore(SidecarReader):
+    """ Point reader for derived-field sidecars with a small LRU of open memory maps.
+
+    Args:
+        max_files (int): Maximum number of sidecars kept mapped
+    """
+
+    def paths(self, nc_path):
+        return derived_paths(nc_path)
+
+    def valid(self, meta):
+        return meta.get('vars') == DERIVED_VARS
+
+    def read_point(self, nc_path, x, y, names=DERIVED_VARS):
+        """ Dict of derived values at grid point (x, y), or None if there is no up to date sidecar """
+        store = self._open(nc_path)
+        if store is None:
+            return None
+        arr, meta = store
+        return {var: decode(arr, meta, var, (x, y)).item() for var in names}
+
+
+if __name__ == "__main__":
+    # python derived.py data/MILES_ptype_hrrr_*.nc
+    for fil in sys.argv[1:]:
+        print(fil)
+        derived_fields(fil)
@@ -0,0 +1,132 @@
+import json
+import os
+import sys
+import numpy as np
+
+# Nearest HRRR grid point lookup for arbitrary lat/lon
+#
+# Replaces the nn.json dictionary. The index is a directory with three files:
+#   meta.json   - lattice origin/spacing and the HRRR grid shape
+#   lattice.npy - int16 (nlat, nlon, 2) nearest grid point on a 0.05 deg lattice (-1 outside the domain)
+#   latlon.npy  - float32 (2, ny, nx) grid latitudes/longitudes used to refine the lattice guess
+# Both arrays are opened with mmap_mode='r', so every Gunicorn worker shares the same page cache
+# instead of holding its own copy.
+
+LATTICE_STEP = 0.05
+
+# Lattice points further than this (degrees) from any grid point are outside the domain
+MAX_DISTANCE = 0.05
+
+
+def _wrap_lon(lon):
+    """ Wrap longitudes to [-180, 180) so 0-360 NetCDF longitudes match Leaflet longitudes """
+    return (np.asarray(lon) + 180.0) % 360.0 - 180.0
+
+
+def _to_xyz(lat, lon):
+    """ Unit sphere coordinates, so KD-tree distances are not distorted near the poles or the dateline """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def build_index(nc_path, out_path, step=LATTICE_STEP, max_distance=MAX_DISTANCE):
+    """ Build a grid index from the latitude/longitude fields of any HRRR NetCDF file.
+
+    Args:
+        nc_path (str): NetCDF file containing 2D 'latitude' and 'longitude' variables
+        out_path (str): Directory to write the index to
+        step (float): Lattice spacing in degrees
+        max_distance (float): Distance in degrees beyond which a point is considered outside the grid
+    """
+    import xarray as xr
+    from scipy.spatial import cKDTree
+
+    with xr.open_dataset(nc_path) as ds:
+        lats = ds['latitude'].values.astype('float32')
+        lons = _wrap_lon(ds['longitude'].values).astype('float32')
+
+    # Lattice covering the grid's bounding box
+    lat0 = np.floor(lats.min() / step) * step
+    lon0 = np.floor(lons.min() / step) * step
+    nlat = int(np.ceil((lats.max() - lat0) / step)) + 1
+    nlon = int(np.ceil((lons.max() - lon0) / step)) + 1
+    glat, glon = np.meshgrid(lat0 + np.arange(nlat) * step, lon0 + np.arange(nlon) * step, indexing='ij')
+
+    # Nearest grid point for every lattice point
+    tree = cKDTree(_to_xyz(lats.ravel(), lons.ravel()))
+    dist, idx = tree.query(_to_xyz(glat.ravel(), glon.ravel()))
+    rows, cols = np.unravel_index(idx, lats.shape)
+    lattice = np.stack((rows, cols), axis=-1).astype('int16')
+    lattice[dist > 2 * np.sin(np.radians(max_distance) / 2)] = -1
+
+    os.makedirs(out_path, exist_ok=True)
+    np.save(os.path.join(out_path, 'lattice.npy'), lattice.reshape(nlat, nlon, 2))
+    np.save(os.path.join(out_path, 'latlon.npy'), np.stack((lats, lons)))
+    meta = {"lat0": float(lat0), "lon0": float(lon0), "step": step, "max_distance": max_distance,
+            "lattice_shape": [nlat, nlon], "grid_shape": list(lats.shape), "source": os.path.basename(nc_path)}
+    with open(os.path.join(out_path, 'meta.json'), 'w') as json_file:
+        json.dump(meta, json_file)
+
+
+class GridIndex:
+    """ Memory-mapped nearest grid point lookup.
+
+    Args:
+        path (str): Directory written by build_index
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as json_file:
+            meta = json.load(json_file)
+        self.lat0 = meta['lat0']
+        self.lon0 = meta['lon0']
+        self.step = meta['step']
+        self.max_distance = meta['max_distance']
+        self.lattice = np.load(os.path.join(path, 'lattice.npy'), mmap_mode='r')
+        self.latlon = np.load(os.path.join(path, 'latlon.npy'), mmap_mode='r')
+        self.shape = self.latlon.shape[1:]
+
+    def lookup(self, lat, lon):
+        """ Nearest grid point to (lat, lon).
+
+        Args:
+            lat (float): Latitude in degrees
+            lon (float): Longitude in degrees (either -180/180 or 0/360)
+        Returns:
+            Tuple: (x, y) indices into the (y, x) dimensions of the NetCDF, or None if outside the grid
+        """
+        lon = float(_wrap_lon(lon))
+        i = int(round((lat - self.lat0) / self.step))
+        j = int(round((lon - self.lon0) / self.step))
+        if i < 0 or j < 0 or i >= self.lattice.shape[0] or j >= self.lattice.shape[1]:
+            return None
+
+        # Lattice guess is within a grid point or two of the answer
+        x, y = (int(v) for v in self.lattice[i, j])
+        if x < 0:
+            return None
+        x, y, dist = self._refine(lat, lon, x, y)
+        if dist > self.max_distance:
+            return None
+        return (x, y)
+
+    def _refine(self, lat, lon, x, y):
+        """ Walk downhill over 3x3 neighbourhoods until the current grid point is the closest """
+        coslat = np.cos(np.radians(lat))
+        best = None
+        while True:
+            x0, x1 = max(x - 1, 0), min(x + 2, self.shape[0])
+            y0, y1 = max(y - 1, 0), min(y + 2, self.shape[1])
+            dlat = self.latlon[0, x0:x1, y0:y1] - lat
+            dlon = (self.latlon[1, x0:x1, y0:y1] - lon) * coslat
+            dist = dlat * dlat + dlon * dlon
+            i, j = np.unravel_index(np.argmin(dist), dist.shape)
+            if best is not None and dist[i, j] >= best:
+                return x, y, float(np.sqrt(best))
+            x, y, best = x0 + int(i), y0 + int(j), float(dist[i, j])
+
+
+if __name__ == "__main__":
+    # python gridindex.py data/MILES_ptype_hrrr_2024-04-30_0000_f01.nc gridindex
+    build_index(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'gridindex')
@@ -0,0 +1,47 @@
+import gc
+import os
+import time
+
+# Gunicorn settings for the backend, picked up by `gunicorn app:app` run from this directory
+#
+# With preload_app the master imports app.py (grid index, NumPy model export, caches) once and the workers
+# are forked from it, sharing those pages copy-on-write instead of each importing and loading them again.
+# Boot time and the memory of the master and of each worker are logged at startup.
+#
+#   PTYPE_WORKERS (4), PTYPE_THREADS (4), PTYPE_BIND (127.0.0.1:5000), PTYPE_PRELOAD (1)
+
+bind = os.environ.get("PTYPE_BIND", "127.0.0.1:5000")
+workers = int(os.environ.get("PTYPE_WORKERS", "4"))
+
+# Threaded workers, so the micro-batcher can group concurrent modSounding requests
+threads = int(os.environ.get("PTYPE_THREADS", "4"))
+
+# TensorFlow does not survive a fork, so the Keras fallback is loaded in each worker
+preload_app = os.environ.get("PTYPE_PRELOAD", "1") != "0" \
+    and os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ptype_model_20240909.npz"))
+
+started = time.perf_counter()
+
+
+def when_ready(server):
+    from memstats import memory_usage, format_usage
+
+    mode = "preloaded app" if preload_app else "app loaded per worker"
+    server.log.info(f"master ready in {time.perf_counter() - started:.1f} s, {mode}: {format_usage(memory_usage())}")
+
+
+def pre_fork(server, worker):
+    # Objects loaded so far live as long as the master, so take them out of the garbage collector,
+    # whose reference bookkeeping would otherwise write to (and so copy) their pages in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    from memstats import memory_usage, format_usage
+
+    worker.log.info(f"worker {worker.pid} ready in {time.perf_counter() - worker.boot_started:.1f} s: "
+                    f"{format_usage(memory_usage())}")
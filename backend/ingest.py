@@ -0,0 +1,257 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Ingest of new MILES_ptype_hrrr netcdfs
+#
+# Polls the data directory. Each new file is processed once its size and mtime have stopped changing, in
+# three steps:
+#   validate - every variable the backend reads is present with the grid index's shape
+#   prepare  - adds the skew-T stat fields (profilemetrics), builds the profile store (profilestore) and
+#              computes the derived surface fields (derived) if the netcdf has their surface inputs
+#   publish  - lists the file in <data>/runs.json, the available runs index served at /runs
+# Files that fail validation are listed under "invalid" and retried only after they change.
+#
+# Run one watcher next to the Gunicorn workers:  python ingest.py data [--interval 10]
+# Each worker polls runs.json (RunIndex) and pre-decodes the ML fields of newly published files into its cache.
+
+NETCDF_PATTERN = re.compile(r"MILES_ptype_hrrr_(\d{4}-\d{2}-\d{2})_(\d{2})00_f(\d{2})\.nc$")
+
+INDEX_NAME = "runs.json"
+
+# Seconds a file's size and mtime must be unchanged before it is ingested (still being copied otherwise)
+SETTLE_SECONDS = 5
+
+
+def parse_name(name):
+    """ (run, date, initialization, forecast hour) of a netcdf file name, or None """
+    match = NETCDF_PATTERN.match(name)
+    if match is None:
+        return None
+    date, init, hour = match.groups()
+    return f"{date}_{init}00", date, init, int(hour)
+
+
+def validate(path, grid_shape=None):
+    """ Reason a netcdf cannot be served, or None if it is valid """
+    import xarray as xr
+    from profilestore import PROFILE_VARS, POINT_VARS
+
+    try:
+        with xr.open_dataset(path) as ds:
+            missing = [var for var in PROFILE_VARS + POINT_VARS + ['heightAboveGround'] if var not in ds]
+            if missing:
+                return f"missing variables {', '.join(missing)}"
+            shape = ds['t_h'].shape[-2:]
+            if grid_shape is not None and tuple(shape) != tuple(grid_shape):
+                return f"grid shape {tuple(shape)} does not match the grid index {tuple(grid_shape)}"
+            for var in PROFILE_VARS:
+                if ds[var].ndim != 4 or ds[var].shape[-2:] != shape:
+                    return f"{var} has shape {ds[var].shape}"
+            for var in POINT_VARS:
+                if ds[var].ndim != 3 or ds[var].shape[-2:] != shape:
+                    return f"{var} has shape {ds[var].shape}"
+                if not ds[var][0, ::50, ::50].notnull().any():
+                    return f"{var} is empty"
+    except Exception as error:
+        return f"unreadable: {error}"
+    return None
+
+
+def prepare(path):
+    """ Add the skew-T stat fields and build the profile store and derived fields if they are missing or stale.
+    The derived fields are optional: netcdfs without their surface inputs (compress.py output) are served without them """
+    import xarray as xr
+    from profilemetrics import add_metric_fields, METRIC_VARS
+    from profilestore import build_store, store_is_current
+    from derived import derived_fields, SOURCE_VARS
+
+    with xr.open_dataset(path) as ds:
+        has_metrics = all(var in ds for var in METRIC_VARS)
+        has_sources = all(var in ds for var in SOURCE_VARS)
+    if not has_metrics:
+        add_metric_fields(path)
+
+    # After add_metric_fields, since rewriting the netcdf makes the store stale
+    if not store_is_current(path):
+        build_store(path)
+    if has_sources:
+        derived_fields(path)
+
+
+def runs_index(names):
+    """ Available runs (newest first) with their forecast hours, from netcdf file names """
+    runs = {}
+    for name in sorted(names):
+        run, date, init, hour = parse_name(name)
+        entry = runs.setdefault(run, {"run": run, "date": date, "initialization": init, "forecastHours": []})
+        entry["forecastHours"].append(hour)
+    return {"updated": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "runs": sorted(runs.values(), key=lambda entry: entry["run"], reverse=True)}
+
+
+class Ingest:
+    """ Polling watcher that validates, prepares and publishes new netcdfs.
+
+    Args:
+        data_dir (str): Directory the netcdfs arrive in
+        grid_shape (tuple): Expected (ny, nx), None to accept any
+        settle (float): Seconds a file must be unchanged before it is processed
+    """
+
+    def __init__(self, data_dir, grid_shape=None, settle=SETTLE_SECONDS):
+        self.data_dir = data_dir
+        self.grid_shape = grid_shape
+        self.settle = settle
+        self.index_path = os.path.join(data_dir, INDEX_NAME)
+
+        # name -> signature it was processed at, and reason for invalid files
+        self.done = {}
+        self.invalid = {}
+
+    def poll(self):
+        """ Process the files that appeared or changed since the last poll, returns their names """
+        now = time.time()
+        processed = []
+        names = sorted(name for name in os.listdir(self.data_dir) if parse_name(name))
+        for name in names:
+            path = os.path.join(self.data_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (st.st_mtime_ns, st.st_size)
+            if self.done.get(name) == signature or now - st.st_mtime < self.settle:
+                continue
+
+            start = time.perf_counter()
+            error = validate(path, self.grid_shape)
+            if error is None:
+                try:
+                    prepare(path)
+                except Exception as prepare_error:
+                    error = f"prepare failed: {prepare_error}"
+            if error is None:
+                self.invalid.pop(name, None)
+                print(f"ingested {name} in {time.perf_counter() - start:.1f} s")
+            else:
+                self.invalid[name] = error
+                print(f"invalid {name}: {error}")
+
+            # prepare rewrites the file, remember the signature it ended up with
+            st = os.stat(path)
+            self.done[name] = (st.st_mtime_ns, st.st_size)
+            processed.append(name)
+
+        # Forget deleted files
+        for name in set(self.done) - set(names):
+            del self.done[name]
+            self.invalid.pop(name, None)
+            processed.append(name)
+
+        if processed or not os.path.exists(self.index_path):
+            self.publish()
+        return processed
+
+    def publish(self):
+        """ Write the available runs index atomically """
+        index = runs_index([name for name in self.done if name not in self.invalid])
+        index["invalid"] = self.invalid
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def run(self, interval=10):
+        while True:
+            self.poll()
+            time.sleep(interval)
+
+
+class RunIndex:
+    """ The backend's view of runs.json, re-read when it changes.
+
+    Args:
+        data_dir (str): Directory holding runs.json
+        on_publish (callable): Called with the paths of newly published netcdfs (e.g. to warm a cache)
+    """
+
+    def __init__(self, data_dir, on_publish=None):
+        self.path = os.path.join(data_dir, INDEX_NAME)
+        self.data_dir = data_dir
+        self.on_publish = on_publish
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.index = None
+        self.published = set()
+        self.pid = None
+
+    def get(self):
+        """ The index, or None if no watcher has written one """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.index = json.load(f)
+                self.mtime = mtime
+            return self.index
+
+    def published_paths(self):
+        index = self.get() or {"runs": []}
+        return [os.path.join(self.data_dir, f"MILES_ptype_hrrr_{entry['run']}_f{hour:02d}.nc")
+                for entry in index["runs"] for hour in entry["forecastHours"]]
+
+    def watch(self, interval=5):
+        """ Call on_publish for new files from a daemon thread (started lazily per process, after any fork) """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self._watch, args=(interval,), daemon=True).start()
+
+    def _watch(self, interval):
+        self.published = set(self.published_paths())
+        while True:
+            time.sleep(interval)
+            try:
+                paths = self.published_paths()
+                new = [path for path in paths if path not in self.published]
+                self.published = set(paths)
+                if new and self.on_publish:
+                    self.on_publish(new)
+            except Exception as error:
+                print("run index:", error)
+
+
+def grid_shape(index_dir):
+    """ Grid shape recorded in a grid index, None if there is none """
+    try:
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            return tuple(json.load(f)["grid_shape"])
+    except FileNotFoundError:
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Watch the data directory and ingest new netcdfs")
+    parser.add_argument("data_dir", nargs="?", default="data")
+    parser.add_argument("--grid-index", default="gridindex")
+    parser.add_argument("--interval", type=float, default=10)
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS)
+    parser.add_argument("--once", action="store_true", help="Process the current files and exit")
+    args = parser.parse_args()
+
+    ingest = Ingest(args.data_dir, grid_shape(args.grid_index), args.settle)
+    if args.once:
+        ingest.poll()
+        sys.exit(0)
+    ingest.run(args.interval)
@@ -0,0 +1,32 @@
+import os
+import resource
+
+# Memory usage of a process, split into what it shares with other processes and what is its own
+#
+# With Gunicorn's preload_app the model, grid index and imported modules are loaded once in the master and
+# shared copy-on-write, so the number that grows with worker count is `private`, not `rss`.
+# `pss` divides shared pages between the processes using them, so summing it over workers gives the real total.
+
+
+def memory_usage(pid="self"):
+    """ Dict of rss, pss, shared and private bytes (Linux /proc/<pid>/smaps_rollup, rss only elsewhere) """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+        return {"rss": fields.get("Rss", 0), "pss": fields.get("Pss", 0),
+                "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+                "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+    except OSError:
+        if pid != "self":
+            return {"rss": None, "pss": None, "shared": None, "private": None}
+        # ru_maxrss is the peak, in kB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {"rss": maxrss if os.uname().sysname == "Darwin" else maxrss * 1024, "pss": None, "shared": None, "private": None}
+
+
+def format_usage(usage):
+    return ", ".join(f"{key} {value / 1e6:.0f} MB" for key, value in usage.items() if value is not None)
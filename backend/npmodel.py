@@ -0,0 +1,144 @@
+import sys
+import numpy as np
+
+# Pure NumPy inference for the ptype model and scaler
+#
+# `python npmodel.py export <model.keras> <scaler.json> <out.npz>` dumps the dense layer weights, their
+# activations and the per-feature scaler center/scale (in scaler.groups_ order) to a single .npz.
+# NumpyModel then runs the forward pass without importing TensorFlow/Keras, mlguess or bridgescaler.
+# `python npmodel.py check <model.keras> <scaler.json> <model.npz> <netcdfs...>` compares both on
+# profiles sampled from the netcdfs.
+
+# Matches keras.activations defaults
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "leaky_relu": lambda x: np.where(x > 0, x, 0.2 * x),
+    "elu": lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+}
+
+
+def export(model_path, scaler_path, out_path):
+    """ Export a Keras CategoricalDNN and bridgescaler scaler to an npz.
+
+    Args:
+        model_path (str): Saved .keras model
+        scaler_path (str): Saved bridgescaler json
+        out_path (str): npz to write
+    """
+    import pandas as pd
+    from mlguess.keras.models import CategoricalDNN
+    from keras.models import load_model
+    from bridgescaler import load_scaler
+
+    model = load_model(model_path)
+    scaler = load_scaler(scaler_path)
+    features = [x for y in scaler.groups_ for x in y]
+
+    # Scalers are per-feature affine, so two probes recover center and scale whatever their type
+    zeros = scaler.transform(pd.DataFrame(np.zeros((1, len(features))), columns=features))[features].values[0]
+    ones = scaler.transform(pd.DataFrame(np.ones((1, len(features))), columns=features))[features].values[0]
+    scale = 1.0 / (ones - zeros)
+    center = -zeros * scale
+
+    arrays = {"features": np.array(features), "center": center, "scale": scale,
+              "evidential": np.array(bool(getattr(model, "evidential", True)))}
+    activations = []
+    for layer in model.layers:
+        kind = type(layer).__name__
+        # Identity at inference time
+        if kind in ("Dropout", "GaussianNoise"):
+            continue
+        if kind != "Dense":
+            raise ValueError(f"Unsupported layer {layer.name} ({kind})")
+        activation = layer.activation.__name__
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unsupported activation {activation} in {layer.name}")
+        kernel, bias = layer.get_weights()
+        arrays[f"kernel_{len(activations)}"] = kernel
+        arrays[f"bias_{len(activations)}"] = bias
+        activations.append(activation)
+    arrays["activations"] = np.array(activations)
+    np.savez(out_path, **arrays)
+
+
+class NumpyModel:
+    """ Forward pass of an exported model.
+
+    Args:
+        path (str): npz written by export
+    """
+
+    def __init__(self, path):
+        with np.load(path) as npz:
+            self.features = npz["features"].tolist()
+            self.center = npz["center"].astype('float32')
+            self.scale = npz["scale"].astype('float32')
+            self.evidential = bool(npz["evidential"])
+            activations = npz["activations"].tolist()
+            self.layers = [(npz[f"kernel_{i}"].astype('float32'), npz[f"bias_{i}"].astype('float32'), ACTIVATIONS[a])
+                           for i, a in enumerate(activations)]
+
+    def predict(self, rows):
+        """ Probabilities and evidential uncertainty for unscaled profiles.
+
+        Args:
+            rows (np.ndarray): (n, 84) temperature, dewpoint, u and v profiles in features order
+        Returns:
+            Tuple: probabilities (n, 4) and uncertainty (n,) (None if the model is not evidential)
+        """
+        out = (np.asarray(rows, dtype='float32') - self.center) / self.scale
+        for kernel, bias, activation in self.layers:
+            out = activation(out @ kernel + bias)
+        if not self.evidential:
+            return out, None
+
+        # Same as CategoricalDNN.calc_uncertainty
+        alpha = np.maximum(out, 0) + 1
+        S = alpha.sum(axis=1, keepdims=True)
+        return alpha / S, out.shape[1] / S[:, 0]
+
+
+def check(model_path, scaler_path, npz_path, nc_paths, n=2000, tolerance=1e-4):
+    """ Compare NumpyModel against the Keras model on profiles sampled from netcdfs.
+
+    Returns:
+        bool: True if probabilities and uncertainty agree within tolerance
+    """
+    import pandas as pd
+    import xarray as xr
+    from mlguess.keras.models import CategoricalDNN
+    from keras.models import load_model
+    from bridgescaler import load_scaler
+    from profilestore import MODEL_PROFILE_VARS
+
+    model = load_model(model_path)
+    scaler = load_scaler(scaler_path)
+    npmodel = NumpyModel(npz_path)
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for fil in nc_paths:
+        with xr.open_dataset(fil) as ds:
+            ny, nx = ds['t_h'].shape[-2:]
+            x = rng.integers(0, ny, n // len(nc_paths) + 1)
+            y = rng.integers(0, nx, n // len(nc_paths) + 1)
+            profiles = [ds[var][0].values[:, x, y].T for var in MODEL_PROFILE_VARS]
+            rows.append(np.concatenate(profiles, axis=1))
+    rows = np.concatenate(rows)[:n]
+
+    pred = model.predict(scaler.transform(pd.DataFrame(rows, columns=npmodel.features)), return_uncertainties=True)
+    probs, uncertainty = npmodel.predict(rows)
+    prob_error = np.abs(np.asarray(pred[0]) - probs).max()
+    u_error = np.abs(np.asarray(pred[1])[:, 0] - uncertainty).max()
+    print(f"{len(rows)} profiles, max abs error: probabilities {prob_error:.2e}, uncertainty {u_error:.2e}")
+    return prob_error <= tolerance and u_error <= tolerance
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "export":
+        export(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif sys.argv[1] == "check":
+        sys.exit(0 if check(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5:]) else 1)
@@ -0,0 +1,144 @@
+import os
+import sys
+import numpy as np
+
+# Skew-T warm nose / cold layer statistics
+#
+# calc_profile_metrics_grid works on any (..., level) temperature array at once, so the same code
+# serves a single edited sounding and a whole (y, x, level) HRRR cube.
+# `python profilemetrics.py data/MILES_ptype_hrrr_*.nc` writes the statistics into each netcdf as
+# (time, y, x) fields, which the backend reads instead of recomputing them and which can be contoured
+# like any other field.
+
+# Heights (m AGL) of the 21 profile levels
+HEIGHTS = np.array([0,250,500,750,1000,1250,1500,1750,2000,2250,2500,2750,3000,3250,3500,3750,4000,4250,4500,4750,5000])
+
+# Netcdf variable names, in the order the frontend lists them
+METRIC_VARS = ['upper_nose_height_agl', 'lower_nose_height_agl', 'warm_nose_depth_m', 'warm_nose_area',
+               'cold_layer_depth_m', 'cold_layer_area']
+
+
+# np.trapz was renamed in NumPy 2.0
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
+
+
+def masked_trapezoid(t, mask, resolution):
+    """ abs(trapezoid(t[mask], dx=mask.sum() * resolution)) per profile, 0 with fewer than two levels.
+
+    Profiles are grouped by mask and each group integrated with one trapezoid call over its levels, so the
+    result is bit for bit that of the per-profile computation (in t's dtype), which the frontend truncates
+    to an integer.
+    """
+    nlev = t.shape[-1]
+    flat_t = t.reshape(-1, nlev)
+    flat_mask = mask.reshape(-1, nlev)
+    keys = flat_mask.astype('int64') @ (1 << np.arange(nlev, dtype='int64'))
+    order = np.argsort(keys, kind='stable')
+    starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+    out = np.zeros(len(flat_t), dtype=t.dtype)
+    for start, stop in zip(starts, np.append(starts[1:], len(order))):
+        rows = order[start:stop]
+        levels = np.flatnonzero(flat_mask[rows[0]])
+        if len(levels) > 1:
+            out[rows] = np.abs(trapezoid(flat_t[np.ix_(rows, levels)], dx=len(levels) * resolution, axis=-1))
+    return out.reshape(t.shape[:-1])
+
+
+def calc_profile_metrics_grid(t, resolution=250):
+    """ Bourgouin warm nose / cold layer statistics for many temperature profiles.
+
+    Areas are the trapezoidal integrals used by the original per-profile version: over the warm levels with
+    dx = (number of warm levels) * resolution, and over the cold levels below the warm nose likewise.
+    They are computed in t's dtype (float32 for netcdf profiles), like the original.
+
+    Args:
+        t (np.ndarray): Temperature (C) with levels on the last axis
+        resolution (int): Vertical spacing of the levels in meters
+    Returns:
+        Dict: METRIC_VARS to float64 arrays of shape t.shape[:-1], NaN where there is no elevated warm nose
+    """
+    t = np.asarray(t)
+    if not np.issubdtype(t.dtype, np.floating):
+        t = t.astype('float64')
+    nlev = t.shape[-1]
+    levels = np.arange(nlev)
+
+    # Warm levels and nose top/bottom
+    warm = t > 0
+    nwarm = warm.sum(axis=-1)
+    bottom = np.argmax(warm, axis=-1)
+    top = nlev - 1 - np.argmax(warm[..., ::-1], axis=-1)
+
+    # Cold levels below the nose
+    ncold = ((t < 0) & (levels < bottom[..., None])).sum(axis=-1)
+    valid = (nwarm > 0) & (ncold > 0)
+
+    warm_area = masked_trapezoid(t, warm, resolution)
+
+    # Cold layer starts at the surface, so it is the first ncold levels
+    last_cold = np.maximum(ncold - 1, 0)
+    cold_area = masked_trapezoid(t, levels < ncold[..., None], resolution)
+
+    metrics = {
+        'upper_nose_height_agl': HEIGHTS[top],
+        'lower_nose_height_agl': HEIGHTS[bottom],
+        'warm_nose_depth_m': (top - bottom) * resolution,
+        'warm_nose_area': warm_area,
+        'cold_layer_depth_m': last_cold * resolution,
+        'cold_layer_area': cold_area,
+    }
+    return {var: np.where(valid, values, np.nan) for var, values in metrics.items()}
+
+
+def format_metrics(values):
+    """ Frontend representation of one profile's statistics (strings, 'N/A' without a warm nose) """
+    if any(np.isnan(values[var]) for var in METRIC_VARS):
+        return {var: 'N/A' for var in METRIC_VARS}
+    return {var: str(int(values[var])) for var in METRIC_VARS}
+
+
+def calc_profile_metrics(x, resolution=250):
+    """ Statistics for a single 21 level temperature profile.
+
+    Args:
+        x (np.ndarray): Temperature profile (C)
+        resolution (int): Vertical spatial resolution of profile in meters.
+    Returns:
+        Dict: Dictionary of statistics for elevated cold / warm layers
+    """
+    return format_metrics(calc_profile_metrics_grid(x, resolution))
+
+
+def add_metric_fields(nc_path, rows=128):
+    """ Compute the statistics for every grid point of a netcdf and write them into it.
+
+    Args:
+        nc_path (str): Netcdf with a (time, level, y, x) 't_h' variable
+        rows (int): Grid rows processed at a time, to bound memory
+    """
+    import shutil
+    import xarray as xr
+
+    # Only t_h is read, a block of rows at a time
+    with xr.open_dataset(nc_path) as ds:
+        ny, nx = ds['t_h'].shape[-2:]
+        dims = ('time',) + ds['t_h'].dims[-2:]
+        fields = {var: np.full((1, ny, nx), np.nan, dtype='float32') for var in METRIC_VARS}
+        for start in range(0, ny, rows):
+            t = np.moveaxis(ds['t_h'][0, :, start:start + rows].values, 0, -1)
+            for var, values in calc_profile_metrics_grid(t).items():
+                fields[var][0, start:start + rows] = values
+
+    # Append the new variables to a copy (the existing ones are not rewritten), then replace atomically
+    # so the backend never sees a partial file
+    tmp_path = nc_path + '.tmp'
+    shutil.copyfile(nc_path, tmp_path)
+    xr.Dataset({var: (dims, fields[var]) for var in METRIC_VARS}).to_netcdf(
+        tmp_path, mode='a', encoding={var: {'zlib': True, 'complevel': 4} for var in METRIC_VARS})
+    os.replace(tmp_path, nc_path)
+
+
+if __name__ == "__main__":
+    for fil in sys.argv[1:]:
+        print(fil)
+        add_metric_fields(fil)
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import numpy as np
+from profilemetrics import METRIC_VARS
+from sidecar import SidecarReader, create_array, publish
+
+# Point-optimized profile store
+#
+# The netcdfs are chunked spatially, so a single sounding means decompressing a large chunk of every
+# profile variable. The store is a .npy of [y, x] records next to each netcdf
+# (MILES_ptype_hrrr_<run>.profiles.npy + .profiles.json), so all profile variables plus the ML fields
+# for a grid point are one contiguous ~300 byte read from a memory map. The precomputed skew-T stats
+# (profilemetrics) are included when the netcdf has them.
+#
+# Each record has one field per variable: temperature, dewpoint and wind profiles in float16 (0.03 or
+# better in their ranges), pressure and the scalar (2D) fields in float32, so probabilities and pressure
+# are exactly the netcdf's values and every endpoint returns the same numbers. That is 272 bytes per grid
+# point (296 with the skew-T stats), ~560 MB per file on the HRRR grid, several times the netcdf's size.
+
+# Profiles the model takes, in its feature order (21 levels each)
+MODEL_PROFILE_VARS = ["t_h", "dpt_h", "u_h", "v_h"]
+PROFILE_VARS = ["isobaricInhPa_h"] + MODEL_PROFILE_VARS
+POINT_VARS = ["ML_rain", "ML_snow", "ML_icep", "ML_frzr", "ML_u"]
+
+# Stored when present (point_vars missing from a netcdf are skipped)
+STORE_POINT_VARS = POINT_VARS + METRIC_VARS
+
+# Profiles stored at full precision (float16 only resolves 0.5 hPa around 1000 hPa)
+FLOAT32_PROFILES = ["isobaricInhPa_h"]
+
+# Layout version, stores written by older code are treated as missing
+STORE_VERSION = 2
+
+
+def store_paths(nc_path):
+    """ (array, metadata) paths of the store belonging to a netcdf """
+    base = nc_path[:-3] if nc_path.endswith('.nc') else nc_path
+    return base + '.profiles.npy', base + '.profiles.json'
+
+
+def record_dtype(profile_vars, point_vars, nlev):
+    """ Structured dtype of one grid point's record """
+    return np.dtype([(var, '<f4' if var in FLOAT32_PROFILES else '<f2', (nlev,)) for var in profile_vars]
+                    + [(var, '<f4') for var in point_vars])
+
+
+def store_is_current(nc_path):
+    """ Whether the store of a netcdf exists in the current layout and is not older than the netcdf """
+    npy_path, json_path = store_paths(nc_path)
+    try:
+        with open(json_path) as json_file:
+            meta = json.load(json_file)
+        return meta.get('version') == STORE_VERSION and os.path.getmtime(npy_path) >= os.path.getmtime(nc_path)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def build_store(nc_path, profile_vars=PROFILE_VARS, point_vars=STORE_POINT_VARS):
+    """ Write the profile store for a netcdf, one variable at a time to bound memory.
+
+    Args:
+        nc_path (str): Netcdf to convert
+        profile_vars (list): (time, level, y, x) variables
+        point_vars (list): (time, y, x) variables
+    """
+    import xarray as xr
+
+    npy_path, json_path = store_paths(nc_path)
+    with xr.open_dataset(nc_path) as ds:
+        point_vars = [var for var in point_vars if var in ds]
+        agl = ds['heightAboveGround'].values
+        nlev = len(agl)
+        ny, nx = ds[profile_vars[0]].shape[-2:]
+
+        out = create_array(npy_path, record_dtype(profile_vars, point_vars, nlev), (ny, nx))
+        for var in profile_vars:
+            out[var] = np.moveaxis(ds[var][0].values, 0, -1)
+        for var in point_vars:
+            out[var] = ds[var][0].values
+        out.flush()
+        del out
+
+    publish(npy_path, json_path,
+            {"version": STORE_VERSION, "profile_vars": list(profile_vars), "point_vars": point_vars, "agl": agl.tolist()})
+
+
+class ProfileStore(SidecarReader):
+    """ Reader for profile stores with a small LRU of open memory maps.
+
+    Args:
+        max_files (int): Maximum number of stores kept mapped
+    """
+
+    def paths(self, nc_path):
+        return store_paths(nc_path)
+
+    def valid(self, meta):
+        return meta.get('version') == STORE_VERSION
+
+    def read_point(self, nc_path, x, y):
+        """ Profile and point fields at grid point (x, y).
+
+        Args:
+            nc_path (str): Netcdf the store was built from
+            x (int): Index into the netcdf y dimension
+            y (int): Index into the netcdf x dimension
+        Returns:
+            Dict: Variable name to float32 array (profiles) or float (point fields) plus 'agl',
+                or None if there is no up to date store for nc_path
+        """
+        store = self._open(nc_path)
+        if store is None:
+            return None
+        arr, meta = store
+
+        # Single contiguous read of the whole record
+        record = arr[x, y].copy()
+        point = {"agl": np.asarray(meta['agl'])}
+        for var in meta['profile_vars']:
+            point[var] = record[var].astype('float32')
+        for var in meta['point_vars']:
+            point[var] = np.float32(record[var])
+        return point
+
+
+if __name__ == "__main__":
+    # python profilestore.py data/MILES_ptype_hrrr_*.nc
+    for fil in sys.argv[1:]:
+        print(fil)
+        build_store(fil)
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+from derived import PRECIP_VARS
+
+# Ptype statistics over a region of the grid
+#
+# A region (lat/lon box or GeoJSON polygon) becomes a mask of grid points, stored as row runs
+# (row, first column, last column + 1) plus the flat indices of its points, and cached by geometry.
+#
+# Per netcdf, RegionTables keeps row integral images: for each grid row the running sum along x of the
+# quantized probabilities and uncertainty, of the points where each ptype is the most likely one and of the
+# points where HRRR has precipitation (if the netcdf has the categorical fields; compress.py output does not).
+# A run's sum is then two lookups, so sums, means and fractions cost O(rows) rather than O(points).
+# That is 30 bytes per grid point, about 57 MB per file on the 1059 x 1799 HRRR grid.
+# Full 2D summed-area tables would make grid rectangles O(1), but lat/lon regions are not rectangles on the
+# Lambert grid and 2D tables need 64 bit sums (twice the memory).
+# The maximum and the fractions above thresholds are taken over the mask's points, which costs O(points) but
+# no tables (per-threshold tables would add 24 bytes per grid point) and allows any threshold.
+
+PTYPES = ["rain", "snow", "icep", "frzr"]
+
+# Default probability thresholds
+THRESHOLDS = (0.25, 0.5, 0.75)
+
+# Probabilities are summed as integers in units of 1 / QUANTUM (row sums fit uint32)
+QUANTUM = 10000
+
+
+def region_key(region):
+    return hashlib.sha1(json.dumps(region, sort_keys=True).encode()).hexdigest()
+
+
+def polygons(region):
+    """ Lists of (lon, lat) rings from a [west, south, east, north] box or GeoJSON (Feature(Collection) or geometry).
+    LineStrings are treated as closed rings, as in bounds.geojson. Holes are ignored. """
+    if isinstance(region, (list, tuple)):
+        west, south, east, north = map(float, region)
+        return [[(west, south), (east, south), (east, north), (west, north)]]
+    kind = region.get('type')
+    if kind == 'FeatureCollection':
+        return [ring for feature in region['features'] for ring in polygons(feature)]
+    if kind == 'Feature':
+        return polygons(region['geometry'])
+    if kind == 'Polygon':
+        return [region['coordinates'][0]]
+    if kind == 'MultiPolygon':
+        return [polygon[0] for polygon in region['coordinates']]
+    if kind == 'LineString':
+        return [region['coordinates']]
+    if kind == 'MultiLineString':
+        return list(region['coordinates'])
+    raise ValueError(f"Unsupported region type {kind}")
+
+
+class RegionMasks:
+    """ Cached grid masks of regions.
+
+    Args:
+        latlon (np.ndarray): (2, ny, nx) grid latitudes and longitudes in [-180, 180) (GridIndex.latlon)
+        max_regions (int): Masks kept
+    """
+
+    def __init__(self, latlon, max_regions=256):
+        self.latlon = latlon
+        self.max_regions = max_regions
+        self.lock = threading.Lock()
+        self.masks = OrderedDict()
+
+    def mask(self, region):
+        """ {"rows", "starts", "stops", "index"} of the grid points inside region """
+        key = region_key(region)
+        with self.lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+
+        mask = self._build(polygons(region))
+        with self.lock:
+            self.masks[key] = mask
+            while len(self.masks) > self.max_regions:
+                self.masks.popitem(last=False)
+        return mask
+
+    def _build(self, rings):
+        from matplotlib.path import Path
+
+        ny, nx = self.latlon.shape[1:]
+        inside = np.zeros((ny, nx), dtype=bool)
+        for ring in rings:
+            ring = np.asarray(ring, dtype='float64')[:, :2]
+            lon = (ring[:, 0] + 180) % 360 - 180
+
+            # Only test the grid points within the ring's bounding box
+            lat = ring[:, 1]
+            near = (self.latlon[0] >= lat.min()) & (self.latlon[0] <= lat.max()) \
+                & (self.latlon[1] >= lon.min()) & (self.latlon[1] <= lon.max())
+            rows, cols = np.nonzero(near)
+            if not len(rows):
+                continue
+            points = np.column_stack((self.latlon[1][rows, cols], self.latlon[0][rows, cols]))
+            hit = Path(np.column_stack((lon, lat))).contains_points(points)
+            inside[rows[hit], cols[hit]] = True
+
+        # Runs of consecutive points along each row
+        edges = np.diff(np.pad(inside, ((0, 0), (1, 1))).astype('int8'), axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        stops = np.nonzero(edges == -1)[1]
+        return {"rows": rows, "starts": starts, "stops": stops, "index": np.flatnonzero(inside)}
+
+
+class RegionTables:
+    """ Row integral images of the ML fields of netcdfs, built on first use.
+
+    Args:
+        cache (DatasetCache): Source of the decoded fields
+        max_bytes (int): Memory budget for tables of all files
+    """
+
+    def __init__(self, cache, max_bytes=256 * 1024**2):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.tables = OrderedDict()
+
+    def tables_for(self, path, signature):
+        with self.lock:
+            entry = self.tables.get(path)
+            if entry is not None and entry[0] == signature:
+                self.tables.move_to_end(path)
+                return entry[1]
+
+        tables = self._build(path)
+        with self.lock:
+            self.tables[path] = (signature, tables)
+            while len(self.tables) > 1 and sum(t["nbytes"] for s, t in self.tables.values()) > self.max_bytes:
+                self.tables.popitem(last=False)
+        return tables
+
+    def _build(self, path):
+        def integral(values, dtype):
+            out = np.zeros((values.shape[0], values.shape[1] + 1), dtype=dtype)
+            np.cumsum(values, axis=1, dtype=dtype, out=out[:, 1:])
+            return out
+
+        probs = np.stack([np.nan_to_num(self.cache.field(path, 'ML_' + p)) for p in PTYPES])
+        uncertainty = np.nan_to_num(self.cache.field(path, 'ML_u'))
+        dominant = probs.argmax(axis=0)
+
+        tables = {
+            "sum": [integral(np.rint(p * QUANTUM).astype('uint32'), 'uint32') for p in probs],
+            "u_sum": integral(np.rint(uncertainty * QUANTUM).astype('uint32'), 'uint32'),
+            "dominant": [integral(dominant == i, 'uint16') for i in range(len(PTYPES))],
+            "precip": None,
+        }
+        if all(var in self.cache.dataset(path) for var in PRECIP_VARS):
+            precip = np.logical_or.reduce([self.cache.field(path, var) != 0 for var in PRECIP_VARS])
+            tables["precip"] = integral(precip, 'uint16')
+        tables["nbytes"] = sum(t.nbytes for t in tables["sum"] + tables["dominant"] + [tables["u_sum"], tables["precip"]]
+                               if t is not None)
+        return tables
+
+
+def run_sum(table, mask):
+    """ Sum of a row integral image over the runs of a mask """
+    return int(table[mask["rows"], mask["stops"]].sum(dtype='int64') - table[mask["rows"], mask["starts"]].sum(dtype='int64'))
+
+
+def region_stats(tables, fields, mask, thresholds=THRESHOLDS):
+    """ Statistics of one file over a region mask.
+
+    Args:
+        tables (dict): RegionTables of the file
+        fields (dict): 'ML_<ptype>' decoded fields, for the maxima and threshold fractions
+        mask (dict): RegionMasks mask
+        thresholds (iterable): Probability thresholds to report
+    Returns:
+        Dict: points, precipitation fraction (None without HRRR categorical fields), most common dominant
+        ptype and per ptype mean, max, dominant fraction and fraction above each threshold
+    """
+    n = len(mask["index"])
+    if n == 0:
+        return {"points": 0}
+
+    dominant = [run_sum(table, mask) for table in tables["dominant"]]
+    precip = tables["precip"]
+    stats = {"points": n, "precipFraction": run_sum(precip, mask) / n if precip is not None else None,
+             "dominant": PTYPES[int(np.argmax(dominant))],
+             "uncertainty": {"mean": run_sum(tables["u_sum"], mask) / QUANTUM / n}}
+    for i, ptype in enumerate(PTYPES):
+        values = fields['ML_' + ptype].ravel()[mask["index"]]
+        stats[ptype] = {"mean": run_sum(tables["sum"][i], mask) / QUANTUM / n,
+                        "max": float(np.nanmax(values)),
+                        "dominantFraction": dominant[i] / n,
+                        "fractionAbove": {str(t): int(np.count_nonzero(values >= t)) / n for t in thresholds}}
+    return stats
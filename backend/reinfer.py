@@ -0,0 +1,155 @@
+import argparse
+import os
+import shutil
+import time
+from multiprocessing import Pool
+import numpy as np
+from derived import PRECIP_VARS
+from profilestore import MODEL_PROFILE_VARS, POINT_VARS
+
+# Full-grid ptype inference
+#
+# Recomputes ML_rain/ML_snow/ML_icep/ML_frzr/ML_u of MILES_ptype_hrrr netcdfs with a (new) model, e.g.
+#
+#   python reinfer.py ptype_model_20240909.npz data/MILES_ptype_hrrr_2024-04-30_0000_f*.nc --processes 8
+#
+# The grid is streamed in blocks of rows, so memory is bounded by --chunk-rows whatever the grid size. Each
+# process opens the netcdf and loads the model once. Only points where HRRR reports precipitation (crain,
+# csnow, cicep or cfrzr, the same mask the map layers use) are predicted unless --all is given. Elsewhere
+# the file keeps its previous ML values, or NaN if it had none. Files without those fields (scripts/compress.py
+# output) are predicted everywhere.
+#
+# Models are a NumPy export (.npz, see npmodel.py), or a .keras model together with --scaler.
+# Rewriting the netcdf makes its profile store stale, so rebuild it afterwards (or let ingest.py do it).
+
+# Rows predicted per model call inside a block
+PREDICT_BATCH = 65536
+
+# Per-process state set by init_worker
+worker = {}
+
+
+def load_predictor(model_path, scaler_path=None):
+    """ predict(rows) -> (probabilities (n, 4), uncertainty (n,)) for (n, 84) unscaled profiles """
+    if model_path.endswith(".npz"):
+        from npmodel import NumpyModel
+        return NumpyModel(model_path).predict
+
+    import pandas as pd
+    from mlguess.keras.models import CategoricalDNN
+    from keras.models import load_model
+    from bridgescaler import load_scaler
+    model = load_model(model_path)
+    scaler = load_scaler(scaler_path)
+    features = [x for y in scaler.groups_ for x in y]
+
+    def predict(rows):
+        pred = model.predict(scaler.transform(pd.DataFrame(rows, columns=features)), return_uncertainties=True)
+        return pred[0].numpy(), pred[1].numpy()[:, 0]
+    return predict
+
+
+def init_worker(nc_path, model_path, scaler_path, masked):
+    import xarray as xr
+
+    worker["ds"] = xr.open_dataset(nc_path)
+    worker["predict"] = load_predictor(model_path, scaler_path)
+    worker["masked"] = masked
+
+
+def predict_block(bounds):
+    """ Predictions for grid rows start:stop, returns (start, stop, flat indices, probabilities, uncertainty) """
+    start, stop = bounds
+    ds = worker["ds"]
+    if worker["masked"]:
+        mask = np.logical_or.reduce([ds[var][0, start:stop].values != 0 for var in PRECIP_VARS])
+    else:
+        mask = np.ones((stop - start, ds["t_h"].shape[-1]), dtype=bool)
+    index = np.flatnonzero(mask)
+    if not len(index):
+        return start, stop, index, np.zeros((0, 4), 'float32'), np.zeros(0, 'float32')
+
+    # (points, 84) rows: the 21 levels of t, dpt, u and v, in the model's feature order
+    rows = np.concatenate([ds[var][0, :, start:stop].values.reshape(ds[var].shape[1], -1)[:, index].T
+                           for var in MODEL_PROFILE_VARS], axis=1)
+    probs, uncertainty = [], []
+    for i in range(0, len(rows), PREDICT_BATCH):
+        p, u = worker["predict"](rows[i:i + PREDICT_BATCH])
+        probs.append(np.asarray(p, dtype='float32'))
+        # Non-evidential models have no uncertainty
+        uncertainty.append(np.full(len(p), np.nan, 'float32') if u is None else np.asarray(u, dtype='float32'))
+    return start, stop, index, np.concatenate(probs), np.concatenate(uncertainty)
+
+
+def reinfer(nc_path, model_path, scaler_path=None, processes=4, chunk_rows=64, masked=True):
+    """ Recompute the ML fields of one netcdf in place.
+
+    Args:
+        nc_path (str): MILES_ptype_hrrr netcdf
+        model_path (str): .npz export or .keras model
+        scaler_path (str): bridgescaler json (only for .keras models)
+        processes (int): Worker processes
+        chunk_rows (int): Grid rows per block
+        masked (bool): Predict only where HRRR has precipitation
+    Returns:
+        int: Number of grid points predicted
+    """
+    import xarray as xr
+
+    with xr.open_dataset(nc_path) as ds:
+        ny, nx = ds["t_h"].shape[-2:]
+        if masked and not all(var in ds for var in PRECIP_VARS):
+            print(f"{nc_path}: no HRRR precipitation fields ({', '.join(PRECIP_VARS)}), predicting every point")
+            masked = False
+        fields = {var: ds[var][0].values.astype('float32') if var in ds else np.full((ny, nx), np.nan, 'float32')
+                  for var in POINT_VARS}
+
+    blocks = [(start, min(start + chunk_rows, ny)) for start in range(0, ny, chunk_rows)]
+    count = 0
+    with Pool(processes, initializer=init_worker, initargs=(nc_path, model_path, scaler_path, masked)) as pool:
+        for start, stop, index, probs, uncertainty in pool.imap_unordered(predict_block, blocks):
+            rows, cols = np.unravel_index(index, (stop - start, nx))
+            for i, var in enumerate(POINT_VARS[:4]):
+                fields[var][start + rows, cols] = probs[:, i]
+            fields["ML_u"][start + rows, cols] = uncertainty
+            count += len(index)
+
+    # Write only the ML variables into a copy (the profiles are not read back or rewritten), then replace
+    # atomically. netCDF4 applies each existing variable's scale_factor when writing, and its _FillValue to masked
+    # points (packed int16 variables would otherwise store NaN as 0)
+    import netCDF4
+    tmp_path = nc_path + '.tmp'
+    shutil.copyfile(nc_path, tmp_path)
+    with netCDF4.Dataset(tmp_path, 'a') as nc:
+        dims = nc['t_h'].dimensions
+        for var in POINT_VARS:
+            if var not in nc.variables:
+                nc.createVariable(var, 'f4', (dims[0],) + dims[-2:], zlib=True, complevel=4, fill_value=np.nan)
+            values = fields[var]
+            if '_FillValue' in nc[var].ncattrs():
+                values = np.ma.fix_invalid(values, fill_value=0)
+            nc[var][0] = values
+            nc[var].setncattr("model", os.path.basename(model_path))
+    os.replace(tmp_path, nc_path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the ML ptype fields of netcdfs with a model")
+    parser.add_argument("model", help="NumPy export (.npz) or Keras model (.keras, with --scaler)")
+    parser.add_argument("netcdfs", nargs="+")
+    parser.add_argument("--scaler", help="bridgescaler json for a .keras model")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--chunk-rows", type=int, default=64)
+    parser.add_argument("--all", action="store_true", help="Predict every grid point, not only where HRRR has precipitation")
+    args = parser.parse_args()
+
+    for nc_path in args.netcdfs:
+        start = time.perf_counter()
+        count = reinfer(nc_path, args.model, args.scaler, args.processes, args.chunk_rows, not args.all)
+        elapsed = time.perf_counter() - start
+        print(f"{nc_path}: {count} points in {elapsed:.1f} s ({count / elapsed:.0f} points/s)")
+
+
+if __name__ == "__main__":
+    main()
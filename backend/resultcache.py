@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Memoized endpoint responses
+#
+# /getCSV and /retrieveValue are pure functions of (netcdf, grid point), so their serialized JSON bodies are
+# cached under a key built from the resolved grid point (not the raw float lat/lon). Each entry also stores a
+# signature of the files it was computed from and is ignored once they change.
+#
+# The in-process tier is an LRU bounded by entry count and bytes. With shared_path set, entries are also kept
+# in a SQLite database that every Gunicorn worker on the host opens, so one worker's result serves all of them.
+
+
+class ResultCache:
+    """ Two-tier (process LRU + optional shared SQLite) cache of response bodies.
+
+    Args:
+        max_entries (int): Maximum number of entries kept in process
+        max_bytes (int): Maximum total body size kept in process (and in the shared database)
+        shared_path (str): SQLite file shared between workers, or None for process-only caching
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024**2, shared_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.local = threading.local()
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+        self.puts = 0
+
+    def get(self, key, signature):
+        """ Cached body for key if it was computed from files with this signature, else None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[1]
+
+        body = self._shared_get(key, signature)
+        with self.lock:
+            if body is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["shared_hits"] += 1
+            self._put_local(key, signature, body)
+        return body
+
+    def put(self, key, signature, body):
+        with self.lock:
+            self._put_local(key, signature, body)
+        self._shared_put(key, signature, body)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({"entries": len(self.entries), "bytes": self.nbytes, "max_entries": self.max_entries,
+                          "max_bytes": self.max_bytes, "shared": self.shared_path is not None})
+        return stats
+
+    def _put_local(self, key, signature, body):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= len(old[1])
+        self.entries[key] = (signature, body)
+        self.nbytes += len(body)
+        while self.entries and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            signature, body = self.entries.popitem(last=False)[1]
+            self.nbytes -= len(body)
+            self.counters["evictions"] += 1
+
+    def _db(self):
+        # One connection per thread, reopened after a fork
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.shared_path, timeout=1.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, signature TEXT, body BLOB, atime REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS results_atime ON results (atime)")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def _shared_get(self, key, signature):
+        if self.shared_path is None:
+            return None
+        try:
+            db = self._db()
+            row = db.execute("SELECT signature, body FROM results WHERE key = ?", (repr(key),)).fetchone()
+            if row is None or row[0] != repr(signature):
+                return None
+            db.execute("UPDATE results SET atime = ? WHERE key = ?", (time.time(), repr(key)))
+            return bytes(row[1])
+        except sqlite3.Error:
+            # The shared tier is best effort (e.g. locked by a pruning worker)
+            return None
+
+    def _shared_put(self, key, signature, body):
+        if self.shared_path is None:
+            return
+        try:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (repr(key), repr(signature), body, time.time()))
+            self.puts += 1
+            if self.puts % 256 == 0:
+                self._prune(db)
+        except sqlite3.Error:
+            pass
+
+    def _prune(self, db):
+        # Drop least recently used rows until the database is within max_bytes
+        total = db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        keys = []
+        for key, size in db.execute("SELECT key, LENGTH(body) FROM results ORDER BY atime"):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        db.executemany("DELETE FROM results WHERE key = ?", keys)
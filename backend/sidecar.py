@@ -0,0 +1,83 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Memory-mapped sidecars of netcdfs
+#
+# The profile store (profilestore.py) and the derived fields (derived.py) are each a .npy array plus a .json
+# metadata file next to a netcdf. They are written to temporary files and published array first, so a reader
+# never sees new metadata with an old array. SidecarReader keeps the most recently used ones mapped and drops
+# a sidecar that is older than its netcdf or has been replaced since it was mapped.
+
+
+def create_array(npy_path, dtype, shape):
+    """ Writable memory map of a new sidecar array, published by publish() """
+    return np.lib.format.open_memmap(npy_path + '.tmp', mode='w+', dtype=dtype, shape=shape)
+
+
+def publish(npy_path, json_path, meta):
+    """ Write the metadata and move both files of a sidecar created with create_array() into place """
+    with open(json_path + '.tmp', 'w') as json_file:
+        json.dump(meta, json_file)
+    os.replace(npy_path + '.tmp', npy_path)
+    os.replace(json_path + '.tmp', json_path)
+
+
+class SidecarReader:
+    """ Small LRU of open sidecar memory maps, keyed by netcdf path.
+
+    Subclasses define paths() and may reject metadata in valid().
+
+    Args:
+        max_files (int): Maximum number of sidecars kept mapped
+    """
+
+    def __init__(self, max_files=64):
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.stores = OrderedDict()
+
+    def paths(self, nc_path):
+        """ (array, metadata) paths of the sidecar of a netcdf """
+        raise NotImplementedError
+
+    def valid(self, meta):
+        """ Whether a sidecar with this metadata can be read """
+        return True
+
+    def _open(self, nc_path):
+        """ (array, metadata) of an up to date sidecar, or None """
+        npy_path, json_path = self.paths(nc_path)
+        try:
+            nc_mtime = os.stat(nc_path).st_mtime_ns
+            st = os.stat(npy_path)
+        except FileNotFoundError:
+            return None
+
+        # Stale sidecars are rebuilt (or touched) by ingest.py or layers.py, not while serving
+        if st.st_mtime_ns < nc_mtime:
+            return None
+        signature = (st.st_mtime_ns, st.st_ino)
+
+        with self.lock:
+            entry = self.stores.get(nc_path)
+            if entry is not None and entry[0] == signature:
+                self.stores.move_to_end(nc_path)
+                return entry[1]
+
+        try:
+            with open(json_path, 'r') as json_file:
+                meta = json.load(json_file)
+            arr = np.load(npy_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            return None
+        if not self.valid(meta):
+            return None
+
+        with self.lock:
+            self.stores[nc_path] = (signature, (arr, meta))
+            while len(self.stores) > self.max_files:
+                self.stores.popitem(last=False)
+        return arr, meta
@@ -0,0 +1,197 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Per-stage request timing
+#
+# Routes wrap their stages in `with timer.stage("lookup"):`. Each stage is added to a histogram labelled by
+# route and stage, the whole request to a per-route histogram, and /metrics renders them in Prometheus text
+# format. Stages that run outside a request (the micro-batcher's predict thread) are recorded under the
+# route "batcher", except in callables wrapped with timer.bind() in the request, e.g. work handed to a thread
+# pool, which are recorded under the request's route.
+#
+# Gunicorn workers keep their own counters. With a shared directory set, each worker also dumps them there
+# (at most once a second) and /metrics sums the dumps of all workers, like prometheus_client's multiprocess mode.
+#
+# When disabled no hooks are installed and stage() returns a shared no-op context manager.
+
+# Histogram bucket upper bounds (s), from lookups (~10 us) to cold netcdf reads (seconds)
+BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+NOOP = nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def state(self):
+        return {"counts": self.counts, "sum": self.sum}
+
+
+class Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, time.perf_counter() - self.start)
+
+
+class StageTimer:
+    """ Stage and request duration histograms for a Flask app.
+
+    Args:
+        enabled (bool): Record anything at all
+        server_timing (bool): Add a Server-Timing header with the stages of each response
+        shared_dir (str): Directory where workers dump their counters for /metrics to sum, or None
+    """
+
+    def __init__(self, enabled=True, server_timing=False, shared_dir=None):
+        self.enabled = enabled
+        self.server_timing = server_timing
+        self.shared_dir = shared_dir
+        self.lock = threading.Lock()
+        # Route bound to the current thread by bind()
+        self.local = threading.local()
+        self.stages = {}
+        self.requests = {}
+        self.responses = {}
+        self.last_dump = 0.0
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+        from flask import g, request
+
+        @app.before_request
+        def start_request():
+            g.timing_start = time.perf_counter()
+            g.timing_stages = []
+
+        @app.after_request
+        def finish_request(response):
+            if "timing_start" not in g:
+                return response
+            route = request.endpoint or "unmatched"
+            elapsed = time.perf_counter() - g.timing_start
+            with self.lock:
+                for name, seconds in g.timing_stages:
+                    self.stages.setdefault((route, name), Histogram()).observe(seconds)
+                self.requests.setdefault((route,), Histogram()).observe(elapsed)
+                key = (route, str(response.status_code))
+                self.responses[key] = self.responses.get(key, 0) + 1
+            if self.server_timing:
+                entries = [f"{name};dur={seconds * 1e3:.3f}" for name, seconds in g.timing_stages]
+                response.headers["Server-Timing"] = ", ".join(entries + [f"total;dur={elapsed * 1e3:.3f}"])
+            if self.shared_dir and time.time() - self.last_dump > 1.0:
+                self.dump()
+            return response
+
+    def stage(self, name):
+        """ Context manager timing one stage of the current request """
+        if not self.enabled:
+            return NOOP
+        return Stage(self, name)
+
+    def bind(self, fn):
+        """ Wrap fn so the stages it times in another thread are recorded under the current request's route """
+        from flask import request
+
+        route = request.endpoint or "unmatched"
+
+        def bound(*args, **kwargs):
+            previous = getattr(self.local, "route", None)
+            self.local.route = route
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.local.route = previous
+        return bound
+
+    def record(self, name, seconds):
+        from flask import g, has_request_context
+
+        if has_request_context() and "timing_stages" in g:
+            g.timing_stages.append((name, seconds))
+        else:
+            route = getattr(self.local, "route", None) or "batcher"
+            with self.lock:
+                self.stages.setdefault((route, name), Histogram()).observe(seconds)
+
+    def state(self):
+        with self.lock:
+            return {"stages": [[list(key), hist.state()] for key, hist in self.stages.items()],
+                    "requests": [[list(key), hist.state()] for key, hist in self.requests.items()],
+                    "responses": [[list(key), count] for key, count in self.responses.items()]}
+
+    def dump(self):
+        """ Write this worker's counters for the other workers' /metrics """
+        self.last_dump = time.time()
+        path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state(), f)
+        os.replace(path + ".tmp", path)
+
+    def merged_state(self):
+        """ Counters of this worker, summed with the dumps of the other workers if shared """
+        states = [self.state()]
+        if self.shared_dir:
+            self.dump()
+            states = []
+            for path in glob.glob(os.path.join(self.shared_dir, "*.json")):
+                try:
+                    with open(path) as f:
+                        states.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        merged = {"stages": {}, "requests": {}, "responses": {}}
+        for state in states:
+            for kind in ["stages", "requests"]:
+                for key, hist in state[kind]:
+                    total = merged[kind].setdefault(tuple(key), {"counts": [0] * (len(BUCKETS) + 1), "sum": 0.0})
+                    total["counts"] = [a + b for a, b in zip(total["counts"], hist["counts"])]
+                    total["sum"] += hist["sum"]
+            for key, count in state["responses"]:
+                merged["responses"][tuple(key)] = merged["responses"].get(tuple(key), 0) + count
+        return merged
+
+    def render(self):
+        """ Prometheus text exposition format """
+        state = self.merged_state()
+        lines = []
+
+        def histogram(metric, help, labels, items):
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, hist in sorted(items.items()):
+                label = ",".join(f'{name}="{value}"' for name, value in zip(labels, key))
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], hist["counts"]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{label}}} {hist['sum']}")
+                lines.append(f"{metric}_count{{{label}}} {cumulative}")
+
+        histogram("ptype_stage_seconds", "Time spent in each stage of a request", ["route", "stage"], state["stages"])
+        histogram("ptype_request_seconds", "Time from request start to response", ["route"], state["requests"])
+        lines.append("# HELP ptype_responses_total Responses by route and status code")
+        lines.append("# TYPE ptype_responses_total counter")
+        for (route, status), count in sorted(state["responses"].items()):
+            lines.append(f'ptype_responses_total{{route="{route}",status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
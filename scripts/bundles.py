@@ -0,0 +1,204 @@
+import gzip
+import json
+import os
+import struct
+
+# Animation bundles: every forecast hour of a run/layer in one file
+#
+# Layout (little-endian):
+#   b"PTAB" | uint32 header length | header JSON | one gzip member per forecast hour
+# The header lists each hour's byte offset and length, so a client reads the first few kB and then
+# fetches hours one at a time with Range requests (served by the backend's .bundle route) while animating.
+#
+# Each hour is TopoJSON-like: coordinates are integers on the GeoJSON's 0.01 degree grid
+# (x = translate + i * scale, exact for layers.py output), and every ring or line is an arc stored as
+# its first point followed by deltas, flattened: [x0, y0, dx1, dy1, ...]. Consecutive repeated points are
+# dropped, and so are rings left with fewer than 4 positions (lines with fewer than 2), i.e. contours with no
+# area around a single grid cell, so a decoded hour is valid GeoJSON but not always identical to its input.
+# Arcs get global ids in order of first appearance; when a contour repeats (in the same or an earlier hour,
+# either direction) the geometry refers to the existing arc (~id when reversed) instead of repeating it. An
+# hour's chunk holds only the arcs it introduces, so hours can be decoded in order as they arrive:
+#   {"forecastHour": 1, "arcs": [[...], ...], "features": [{"type": "MultiPolygon", "arcs": [[[0], [~3]]], "properties": {...}}]}
+
+MAGIC = b"PTAB"
+VERSION = 1
+
+# Coordinate resolution of the layer GeoJSONs (geojsoncontour ndigits=2)
+SCALE = 0.01
+
+
+# Fewest positions a line or polygon ring keeps once quantized, smaller ones are dropped
+MIN_POINTS = {"LineString": 2, "MultiLineString": 2, "Polygon": 4, "MultiPolygon": 4}
+
+
+def parts(geometry):
+    """ (type, groups of lines/rings: one per line, or per polygon with its outer ring first) """
+    kind, coords = geometry['type'], geometry['coordinates']
+    if kind == 'LineString':
+        return kind, [[coords]]
+    if kind == 'MultiLineString':
+        return kind, [[line] for line in coords]
+    if kind == 'Polygon':
+        return kind, [coords]
+    if kind == 'MultiPolygon':
+        return kind, coords
+    raise ValueError(f"Unsupported geometry {kind}")
+
+
+class ArcTable:
+    """ Global arc ids, shared across the hours of a bundle """
+
+    def __init__(self, translate):
+        self.translate = translate
+        self.ids = {}
+        self.count = 0
+
+    def quantize(self, coords):
+        points = [(round((x - self.translate[0]) / SCALE), round((y - self.translate[1]) / SCALE)) for x, y, *rest in coords]
+        # Drop repeated points
+        return tuple(p for i, p in enumerate(points) if i == 0 or p != points[i - 1])
+
+    def geometry(self, geometry, new_arcs):
+        """ Arc ids of a geometry, nested like its coordinates, or None if nothing is left of it on the grid.
+
+        Lines and rings that collapse below MIN_POINTS positions (contours around a single grid cell) are
+        dropped, and a polygon goes with its outer ring.
+        """
+        kind, groups = parts(geometry)
+        kept = []
+        for group in groups:
+            points = [self.quantize(coords) for coords in group]
+            if len(points[0]) < MIN_POINTS[kind]:
+                continue
+            kept.append([self.arc(p, new_arcs) for p in points if len(p) >= MIN_POINTS[kind]])
+        if not kept:
+            return None
+        if kind == 'LineString':
+            return kept[0]
+        if kind == 'MultiLineString':
+            return kept
+        if kind == 'Polygon':
+            return [[i] for i in kept[0]]
+        return [[[i] for i in polygon] for polygon in kept]
+
+    def arc(self, points, new_arcs):
+        """ Id of the arc for quantized points (~id if an existing arc is reversed), adding it to new_arcs if it is new """
+        if points in self.ids:
+            return self.ids[points]
+        if points[::-1] in self.ids:
+            return ~self.ids[points[::-1]]
+        arc_id = self.count
+        self.ids[points] = arc_id
+        self.count += 1
+        flat = [points[0][0], points[0][1]]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            flat += [x1 - x0, y1 - y0]
+        new_arcs.append(flat)
+        return arc_id
+
+
+def bounds(geojsons):
+    xs, ys = [], []
+    for geojson in geojsons:
+        for feature in geojson['features']:
+            kind, groups = parts(feature['geometry'])
+            for group in groups:
+                for x, y, *rest in (point for coords in group for point in coords):
+                    xs.append(x)
+                    ys.append(y)
+    return (min(xs), min(ys)) if xs else (0.0, 0.0)
+
+
+def write_bundle(hours, path, layer, run):
+    """ Write the bundle of one run/layer.
+
+    Args:
+        hours (dict): Forecast hour to GeoJSON text
+        path (str): Bundle to (over)write
+        layer (str): Layer name, recorded in the header
+        run (str): Run, e.g. '2024-04-30_0000'
+    Returns:
+        int: Bundle size in bytes
+    """
+    geojsons = {hour: json.loads(text) for hour, text in sorted(hours.items())}
+    translate = [round(v, 2) for v in bounds(geojsons.values())]
+    table = ArcTable(translate)
+
+    chunks, index = [], []
+    for hour, geojson in geojsons.items():
+        new_arcs, features = [], []
+        first = table.count
+        for feature in geojson['features']:
+            arcs = table.geometry(feature['geometry'], new_arcs)
+            if arcs is not None:
+                features.append({"type": feature['geometry']['type'], "arcs": arcs,
+                                 "properties": feature.get('properties', {})})
+        chunk = gzip.compress(json.dumps({"forecastHour": hour, "arcs": new_arcs, "features": features},
+                                         separators=(',', ':')).encode(), compresslevel=9, mtime=0)
+        chunks.append(chunk)
+        index.append({"forecastHour": hour, "length": len(chunk), "arcs": [first, table.count - first]})
+
+    # Offsets depend on the header size, which depends on the offsets: repeat until the header length is stable
+    header = {"version": VERSION, "layer": layer, "run": run, "transform": {"scale": [SCALE, SCALE], "translate": translate},
+              "hours": index}
+    start = None
+    while True:
+        header_bytes = json.dumps(header, separators=(',', ':')).encode()
+        if len(MAGIC) + 4 + len(header_bytes) == start:
+            break
+        start = offset = len(MAGIC) + 4 + len(header_bytes)
+        for entry in index:
+            entry["offset"] = offset
+            offset += entry["length"]
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def read_bundle(path, hour=None):
+    """ Header of a bundle, or (header, decoded GeoJSON FeatureCollection) of one forecast hour """
+    with open(path, 'rb') as f:
+        magic, length = f.read(4), struct.unpack('<I', f.read(4))[0]
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a layer bundle")
+        header = json.loads(f.read(length))
+        if hour is None:
+            return header
+
+        # Arcs of every hour up to the requested one
+        scale, translate = header["transform"]["scale"], header["transform"]["translate"]
+        arcs = []
+        for entry in header["hours"]:
+            f.seek(entry["offset"])
+            chunk = json.loads(gzip.decompress(f.read(entry["length"])))
+            for flat in chunk["arcs"]:
+                x, y, points = 0, 0, []
+                for dx, dy in zip(flat[0::2], flat[1::2]):
+                    x, y = x + dx, y + dy
+                    points.append([round(translate[0] + x * scale[0], 2), round(translate[1] + y * scale[1], 2)])
+                arcs.append(points)
+            if entry["forecastHour"] == hour:
+                break
+        else:
+            raise KeyError(hour)
+
+    def coords(arc_id):
+        return arcs[arc_id] if arc_id >= 0 else arcs[~arc_id][::-1]
+
+    features = []
+    for feature in chunk["features"]:
+        kind, ids = feature["type"], feature["arcs"]
+        if kind == 'LineString':
+            geometry = coords(ids[0])
+        elif kind in ('MultiLineString', 'Polygon'):
+            geometry = [coords(ring[0]) for ring in ids]
+        else:
+            geometry = [[coords(ring[0]) for ring in polygon] for polygon in ids]
+        features.append({"type": "Feature", "geometry": {"type": kind, "coordinates": geometry}, "properties": feature["properties"]})
+    return header, {"type": "FeatureCollection", "features": features}
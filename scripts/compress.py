@@ -1,43 +1,174 @@
 import xarray as xr
-import os
+import numpy as np
+import argparse
 import glob
+import os
+import time
+from multiprocessing import Pool
+
+# Subsets the MILES_ptype_hrrr netcdfs to the variables the backend reads and compresses them
+#
+#   round  - rounds each variable (original behaviour) and writes float zlib level 4
+#   packed - packs each variable into int16 with scale_factor/add_offset (keyed by variable name), chunked for
+#            point profile reads, and reports size and read latency before/after
+#
+# Usage: python compress.py [--mode packed] [--processes 8] [--input-dir .] [--output-dir ./nc_subset_compressed]
+
+keepvars = ["t_h","dpt_h","u_h","v_h","isobaricInhPa_h","ML_rain","ML_snow","ML_icep","ML_frzr","ML_u"]
+
+# Packing per variable: (dtype, scale_factor, add_offset)
+# Ranges covered: temperatures -327..327 C at 0.01 C, winds +-327 m/s at 0.01 m/s,
+# pressure 0..1100 hPa at 0.05 hPa, probabilities/uncertainty 0..1 at 0.0001
+PACKING = {
+    "t_h": ("int16", 0.01, 0.0),
+    "dpt_h": ("int16", 0.01, 0.0),
+    "u_h": ("int16", 0.01, 0.0),
+    "v_h": ("int16", 0.01, 0.0),
+    "isobaricInhPa_h": ("int16", 0.05, 550.0),
+    "ML_rain": ("int16", 0.0001, 0.0),
+    "ML_snow": ("int16", 0.0001, 0.0),
+    "ML_icep": ("int16", 0.0001, 0.0),
+    "ML_frzr": ("int16", 0.0001, 0.0),
+    "ML_u": ("int16", 0.0001, 0.0),
+}
+
+# Profiles are read one grid point at a time: small spatial tiles, all levels in one chunk
+PROFILE_CHUNK = 64
+
+# 2D fields are decoded whole by the backend cache: large chunks
+FIELD_CHUNK = 512
+
+# Grid points sampled for the read latency report
+LATENCY_POINTS = 50
+
 
-fils = glob.glob("./MILES*.nc")
-donefils = glob.glob("./nc_subset_compressed/*")
-for fil in fils:
+def round_file(fil, output_dir):
+    """ Original compression: round and write float zlib """
     head,tail = os.path.split(fil)
-    if f'./nc_subset_compressed/{tail}' in donefils:
-        continue
+    # Open the NetCDF file
+    data = xr.open_dataset(fil)
+
+    # Create a new dataset to store rounded variables
+    rounded_data = xr.Dataset()
+
+    # Define the decimals list
+    decimals = [1, 1, 1, 1, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0, 1, 1, 1, 1, 0, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 0, 2, 0, 2, 0, 2, 0]
+    # Loop through data variables, round them, and store in the new dataset
+    for i, var in enumerate(data.data_vars):
+        if var not in keepvars:
+            continue
+        else:
+            myvar = data[var]
+            decimal = decimals[i]
+
+            # Round the variable
+            rounded_var = myvar.round(decimal)
+
+            # Assign the rounded variable to the new dataset
+            rounded_data[var] = rounded_var
+
+    # Save to a new NetCDF file with compression
+    new_file_path = os.path.join(output_dir, tail)
+    encoding = {var: {'zlib': True, 'complevel': 4} for var in rounded_data.variables}
+
+    rounded_data.to_netcdf(new_file_path, encoding=encoding)
+
+    # Close the datasets
+    data.close()
+    rounded_data.close()
+    return new_file_path
+
+
+def packed_encoding(var, da):
+    """ netCDF encoding packing one variable into an integer type """
+    dtype, scale_factor, add_offset = PACKING[var]
+    if da.ndim == 4:
+        chunksizes = (1, da.shape[1], min(PROFILE_CHUNK, da.shape[2]), min(PROFILE_CHUNK, da.shape[3]))
     else:
-        # Open the NetCDF file
-        data = xr.open_dataset(fil)
-
-        # Create a new dataset to store rounded variables
-        rounded_data = xr.Dataset()
-
-        # Define the decimals list
-        decimals = [1, 1, 1, 1, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0, 1, 1, 1, 1, 0, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 0, 2, 0, 2, 0, 2, 0]
-        keepvars = ["t_h","dpt_h","u_h","v_h","isobaricInhPa_h","ML_rain","ML_snow","ML_icep","ML_frzr","ML_u"]
-        # Loop through data variables, round them, and store in the new dataset
-        for i, var in enumerate(data.data_vars):
-            if var not in keepvars:
-                continue
-            else:
-                myvar = data[var]
-                decimal = decimals[i]
-                
-                # Round the variable
-                rounded_var = myvar.round(decimal)
-
-                # Assign the rounded variable to the new dataset
-                rounded_data[var] = rounded_var
-
-        # Save to a new NetCDF file with compression
-        new_file_path = f'./nc_subset_compressed/{tail}'
-        encoding = {var: {'zlib': True, 'complevel': 4} for var in rounded_data.variables}
-
-        rounded_data.to_netcdf(new_file_path, encoding=encoding)
-
-        # Close the datasets
-        data.close()
-        rounded_data.close()
+        chunksizes = (1,) + tuple(min(FIELD_CHUNK, n) for n in da.shape[1:])
+    return {'dtype': dtype, 'scale_factor': scale_factor, 'add_offset': add_offset,
+            '_FillValue': np.iinfo(dtype).min, 'zlib': True, 'complevel': 4, 'chunksizes': chunksizes}
+
+
+def pack_file(fil, output_dir):
+    """ Packed compression keyed by variable name """
+    head,tail = os.path.split(fil)
+    new_file_path = os.path.join(output_dir, tail)
+    with xr.open_dataset(fil) as data:
+        packed = data[[var for var in keepvars if var in data]]
+        encoding = {var: packed_encoding(var, packed[var]) for var in packed.data_vars}
+
+        # Values outside the packed range would wrap around
+        for var in packed.data_vars:
+            dtype, scale_factor, add_offset = PACKING[var]
+            info = np.iinfo(dtype)
+            lo, hi = add_offset + (info.min + 1) * scale_factor, add_offset + info.max * scale_factor
+            vmin, vmax = float(packed[var].min()), float(packed[var].max())
+            if vmin < lo or vmax > hi:
+                raise ValueError(f"{tail}: {var} range {vmin}..{vmax} does not fit packing {lo}..{hi}")
+
+        packed.to_netcdf(new_file_path + '.tmp', encoding=encoding)
+    os.replace(new_file_path + '.tmp', new_file_path)
+    return new_file_path
+
+
+def read_latency(fil, points):
+    """ Mean seconds to open a file and read a full profile + ML values at a grid point (like /getCSV) """
+    start = time.perf_counter()
+    for x, y in points:
+        with xr.open_dataset(fil) as data:
+            for var in ["isobaricInhPa_h", "t_h", "dpt_h", "u_h", "v_h"]:
+                data[var][0,:,x,y].values
+            for var in ["ML_rain", "ML_snow", "ML_icep", "ML_frzr", "ML_u"]:
+                data[var][0,x,y].values
+    return (time.perf_counter() - start) / len(points)
+
+
+def process_file(args):
+    fil, output_dir, mode = args
+    try:
+        new_file_path = pack_file(fil, output_dir) if mode == "packed" else round_file(fil, output_dir)
+    except Exception as error:
+        print("error", fil, error)
+        return None
+
+    # Size and read latency before/after
+    with xr.open_dataset(fil) as data:
+        ny, nx = data['t_h'].shape[-2:]
+    rng = np.random.default_rng(0)
+    points = list(zip(rng.integers(0, ny, LATENCY_POINTS), rng.integers(0, nx, LATENCY_POINTS)))
+    return {"file": os.path.basename(fil),
+            "size_before": os.path.getsize(fil), "size_after": os.path.getsize(new_file_path),
+            "latency_before": read_latency(fil, points), "latency_after": read_latency(new_file_path, points)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Subset and compress MILES_ptype_hrrr netcdfs")
+    parser.add_argument("--mode", choices=["round", "packed"], default="round")
+    parser.add_argument("--input-dir", default=".")
+    parser.add_argument("--output-dir", default="./nc_subset_compressed")
+    parser.add_argument("--processes", type=int, default=8)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    fils = sorted(glob.glob(os.path.join(args.input_dir, "MILES*.nc")))
+    donefils = {os.path.basename(fil) for fil in glob.glob(os.path.join(args.output_dir, "*.nc"))}
+    todo = [fil for fil in fils if os.path.basename(fil) not in donefils]
+
+    with Pool(processes=args.processes) as pool:
+        reports = [r for r in pool.imap_unordered(process_file, [(fil, args.output_dir, args.mode) for fil in todo]) if r]
+
+    # Size and read latency report
+    for r in sorted(reports, key=lambda r: r["file"]):
+        print(f"{r['file']}: {r['size_before'] / 1e6:8.1f} MB -> {r['size_after'] / 1e6:8.1f} MB, "
+              f"point read {r['latency_before'] * 1e3:7.1f} ms -> {r['latency_after'] * 1e3:7.1f} ms")
+    if reports:
+        before = sum(r["size_before"] for r in reports)
+        after = sum(r["size_after"] for r in reports)
+        print(f"{len(reports)} files ({args.mode}): {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB ({after / before:.0%}), "
+              f"mean point read {np.mean([r['latency_before'] for r in reports]) * 1e3:.1f} ms -> "
+              f"{np.mean([r['latency_after'] for r in reports]) * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
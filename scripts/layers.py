@@ -0,0 +1,349 @@
+import xarray as xr
+import numpy as np
+import geojsoncontour
+import argparse
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from matplotlib.figure import Figure
+
+# Derived-field sidecars are shared with the backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from derived import derived_fields, file_hash
+
+# Map layer generation for every MILES_ptype_hrrr_*.nc
+#
+# Replaces contour.py, hrrr.py, tempcontour.py, dptcontour.py, wbcontour.py, mslpcontour.py,
+# u10contour.py, v10contour.py and uncertaincontour.py. Each netcdf is opened and decoded once, every
+# layer is computed from the same in-memory fields, files are spread over a process pool, and outputs
+# that are already up to date are skipped.
+#
+# Wet bulb, the smoothed surface fields and the precipitation masks come from the derived-field sidecar
+# next to each netcdf (backend/derived.py), computed and written on first use, so they are not recomputed
+# when layers are regenerated and the backend reads the same values.
+#
+# Outputs follow the layout the frontend expects:
+#   <output-dir>/<layer>/MILES_ptype_<evi|hrrr>_<date>_<HH>00_f<FF>_<varname>.geojson
+#
+# Every GeoJSON also gets precompressed .gz and (if the brotli package is installed) .br siblings, which
+# the backend serves according to Accept-Encoding. --size-report prints the transfer size savings per layer.
+#
+# With --tiles, each layer is also cut into a vector tile pyramid (see tiles.py):
+#   <tile-dir>/<layer>/<date>_<HH>00_f<FF>/<z>/<x>/<y>.pbf
+#
+# With --bundles, all forecast hours of a run are also packed into one animation bundle per layer (see bundles.py):
+#   <output-dir>/<layer>/MILES_ptype_<evi|hrrr>_<date>_<HH>00_<varname>.bundle
+#
+# Usage: python layers.py --input-dir /path/to/netcdfs --output-dir ../frontend/public [--layers hrrr_t,hrrr_td] [--tiles] [--bundles] [--force]
+
+# Fields decoded from the netcdf, the others are derived fields
+INPUT_VARS = ["ML_rain", "ML_snow", "ML_icep", "ML_frzr"]
+
+PTYPES = ["rain", "snow", "icep", "frzr"]
+
+# m/s to knots
+KNOTS = 1.94384
+
+# Precompressed siblings written next to each GeoJSON (brotli is optional)
+try:
+    import brotli
+    ENCODINGS = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0), ".br": lambda data: brotli.compress(data, quality=11)}
+except ImportError:
+    ENCODINGS = {".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+
+
+def load_fields(fil, digest=None):
+    """ Decode the first time step of every input variable once, plus the derived fields """
+    with xr.open_dataset(fil) as data:
+        fields = {var: data[var][0].values for var in INPUT_VARS if var in data}
+        fields['lats'] = data['latitude'].values
+        fields['lons'] = data['longitude'].values
+        try:
+            fields.update(derived_fields(fil, data, digest))
+        except KeyError as error:
+            # Netcdfs without the surface fields (compress.py output): only the layers drawn from them fail
+            print("no derived fields", fil, error)
+    return fields
+
+
+def shared(fields, name, fn):
+    """ Compute an intermediate once per file and reuse it across layers """
+    if name not in fields:
+        fields[name] = fn()
+    return fields[name]
+
+
+def precip_mask(fields):
+    # Where HRRR reports any precipitation type
+    return shared(fields, 'precip_mask', lambda: fields['precip'] != 0)
+
+
+def hrrr_field(fields, ptype):
+    # 1 where HRRR reports this ptype
+    return ((fields['precip'] >> PTYPES.index(ptype)) & 1).astype('float')
+
+
+def evi_field(fields, ptype):
+    # ML probability where this ptype is the most likely one and HRRR has precipitation
+    max_values = shared(fields, 'ml_max', lambda: np.maximum.reduce([fields['ML_' + p] for p in PTYPES]))
+    values = fields['ML_' + ptype]
+    return np.where((values == max_values) & precip_mask(fields), values, np.nan)
+
+
+def uncertainty_field(fields):
+    return np.where(precip_mask(fields), fields['ML_u_smooth'], np.nan)
+
+
+# Layer name (= output directory) to how it is drawn
+#   prefix/varname: parts of the output filename
+#   field: fields -> 2D array to contour
+#   kind: 'contourf' (filled polygons) or 'contour' (lines)
+#   shift: longitude offset (the evi layers have always been written in 0-360 longitudes)
+LAYERS = {
+    **{f"evi_{p}": {"prefix": "evi", "varname": p, "field": lambda f, p=p: evi_field(f, p), "kind": "contourf",
+                    "levels": np.arange(0, 1.1, .1), "style": {"extend": "both", "cmap": cmap}, "shift": 0}
+       for p, cmap in zip(PTYPES, ["Greens", "Blues", "Purples", "Reds"])},
+    **{f"hrrr_{p}": {"prefix": "hrrr", "varname": f"hrrr_{p}", "field": lambda f, p=p: hrrr_field(f, p),
+                     "kind": "contourf", "levels": [.5, 1], "style": {"colors": [color], "extend": "max"}, "shift": -360}
+       for p, color in zip(PTYPES, ["#005321", "#0A3C7D", "#7E0611", "#330C61"])},
+    "evi_uncertainty": {"prefix": "evi", "varname": "uncertainty", "field": uncertainty_field, "kind": "contour",
+                        "levels": np.arange(0, 1.1, 0.1), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_t": {"prefix": "hrrr", "varname": "t", "field": lambda f: f['t2m_smooth'],
+               "kind": "contour", "levels": np.arange(-30, 25, 5), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_td": {"prefix": "hrrr", "varname": "td", "field": lambda f: f['d2m_smooth'],
+                "kind": "contour", "levels": np.arange(-30, 25, 5), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_wb": {"prefix": "hrrr", "varname": "wb", "field": lambda f: f['wb2m_smooth'],
+                "kind": "contour", "levels": np.arange(-30, 25, 5), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_mslp": {"prefix": "hrrr", "varname": "mslp", "field": lambda f: f['mslma_smooth'],
+                  "kind": "contour", "levels": np.arange(98800, 105200, 400), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_u10": {"prefix": "hrrr", "varname": "u10", "field": lambda f: f['u10_smooth'] * KNOTS,
+                 "kind": "contour", "levels": np.arange(-30, 35, 5), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+    "hrrr_v10": {"prefix": "hrrr", "varname": "v10", "field": lambda f: f['v10_smooth'] * KNOTS,
+                 "kind": "contour", "levels": np.arange(-30, 35, 5), "style": {"extend": "both", "cmap": "Greys"}, "shift": -360},
+}
+
+
+def run_name(fil):
+    """ '2024-04-30_0000_f01' from '.../MILES_ptype_hrrr_2024-04-30_0000_f01.nc' """
+    return os.path.basename(fil)[len("MILES_ptype_hrrr_"):-3]
+
+
+def output_path(output_dir, layer, run):
+    info = LAYERS[layer]
+    return os.path.join(output_dir, layer, f"MILES_ptype_{info['prefix']}_{run}_{info['varname']}.geojson")
+
+
+def bundle_path(output_dir, layer, run):
+    """ Bundle of a run ('2024-04-30_0000', no forecast hour) """
+    info = LAYERS[layer]
+    return os.path.join(output_dir, layer, f"MILES_ptype_{info['prefix']}_{run}_{info['varname']}.bundle")
+
+
+def layer_outputs(output_dir, tile_dir, layer, run):
+    """ Paths a layer must have up to date: its GeoJSON and compressed siblings, plus its tile pyramid if tiles are enabled """
+    outputs = [output_path(output_dir, layer, run) + ext for ext in [""] + list(ENCODINGS)]
+    if tile_dir:
+        outputs.append(os.path.join(tile_dir, layer, run))
+    return outputs
+
+
+def write_atomic(path, text):
+    """ Write through a temporary file so the frontend never fetches a partial layer """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(text if isinstance(text, bytes) else text.encode())
+    os.replace(tmp_path, path)
+
+
+def write_layer(path, geojson):
+    """ GeoJSON plus its precompressed siblings (written after it, the backend ignores siblings older than the GeoJSON) """
+    data = geojson.encode()
+    write_atomic(path, data)
+    for ext, compress in ENCODINGS.items():
+        write_atomic(path + ext, compress(data))
+
+
+def stale_layers(fil, output_dir, tile_dir, layers, force):
+    """ Layers with an output missing or older than the netcdf, unless the netcdf content is unchanged """
+    run = run_name(fil)
+    if force:
+        return list(layers), None
+    src_mtime = os.path.getmtime(fil)
+
+    def missing(layer):
+        return [path for path in layer_outputs(output_dir, tile_dir, layer, run) if not os.path.exists(path)]
+
+    def older(layer):
+        return [path for path in layer_outputs(output_dir, tile_dir, layer, run) if os.path.exists(path) and os.path.getmtime(path) < src_mtime]
+
+    stale = [layer for layer in layers if missing(layer) or older(layer)]
+    if not stale:
+        return [], None
+
+    # Netcdf touched or copied but not changed: refresh output mtimes instead of regenerating
+    digest = file_hash(fil)
+    manifest_path = os.path.join(output_dir, '.manifest', run + '.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('sha1') == digest:
+            for layer in stale:
+                for path in older(layer):
+                    os.utime(path)
+            stale = [layer for layer in stale if missing(layer)]
+    return stale, digest
+
+
+def render(figure, fields, layer):
+    """ GeoJSON text for one layer """
+    info = LAYERS[layer]
+    figure.clear()
+    ax = figure.add_subplot(111)
+    lons = fields['lons'] + info['shift']
+    if info['kind'] == 'contourf':
+        contours = ax.contourf(lons, fields['lats'], info['field'](fields), levels=info['levels'], **info['style'])
+        return geojsoncontour.contourf_to_geojson(contourf=contours, ndigits=2)
+    contours = ax.contour(lons, fields['lats'], info['field'](fields), levels=info['levels'], **info['style'])
+    return geojsoncontour.contour_to_geojson(contour=contours, ndigits=2)
+
+
+def process_file(args):
+    """ Generate the stale layers of one netcdf.
+
+    Returns:
+        Tuple: (file, {layer: seconds}, load seconds, [failed layers])
+    """
+    fil, output_dir, tile_dir, layers, force = args
+    run = run_name(fil)
+    timings, failed = {}, []
+    todo, digest = stale_layers(fil, output_dir, tile_dir, layers, force)
+    if not todo:
+        return fil, timings, 0.0, failed
+
+    start = time.perf_counter()
+    fields = load_fields(fil, digest)
+    load_time = time.perf_counter() - start
+
+    figure = Figure()
+    for layer in todo:
+        start = time.perf_counter()
+        try:
+            geojson = render(figure, fields, layer)
+            write_layer(output_path(output_dir, layer, run), geojson)
+            if tile_dir:
+                from tiles import write_tiles
+                write_tiles(geojson, os.path.join(tile_dir, layer, run), layer)
+        except Exception as error:
+            print("error", fil, layer, error)
+            failed.append(layer)
+            continue
+        timings[layer] = time.perf_counter() - start
+
+    # Remember which content the outputs were made from
+    manifest_path = os.path.join(output_dir, '.manifest', run + '.json')
+    write_atomic(manifest_path, json.dumps({"sha1": digest or file_hash(fil), "layers": sorted(timings)}))
+    return fil, timings, load_time, failed
+
+
+def process_bundle(args):
+    """ (Re)write the bundle of one layer/run if any of its hours is newer.
+
+    Returns:
+        Tuple: (layer, run, seconds or None if up to date, bundle bytes, gzipped GeoJSON bytes of the same hours)
+    """
+    output_dir, layer, run, hours, force = args
+    from bundles import write_bundle
+
+    paths = {hour: output_path(output_dir, layer, f"{run}_f{hour:02d}") for hour in hours}
+    paths = {hour: path for hour, path in paths.items() if os.path.exists(path)}
+    path = bundle_path(output_dir, layer, run)
+    gz_size = sum(os.path.getsize(p + ".gz") if os.path.exists(p + ".gz") else os.path.getsize(p) for p in paths.values())
+    if not paths:
+        return layer, run, None, 0, 0
+    if not force and os.path.exists(path) and os.path.getmtime(path) >= max(os.path.getmtime(p) for p in paths.values()):
+        return layer, run, None, os.path.getsize(path), gz_size
+
+    start = time.perf_counter()
+    texts = {}
+    for hour, p in paths.items():
+        with open(p) as f:
+            texts[hour] = f.read()
+    size = write_bundle(texts, path, layer, run)
+    return layer, run, time.perf_counter() - start, size, gz_size
+
+
+def size_report(output_dir, layers):
+    """ Raw vs precompressed transfer size of every GeoJSON per layer """
+    print(f"{'layer':<16} {'files':>5} {'raw MB':>9}" + "".join(f" {ext + ' MB':>9} {'saved':>6}" for ext in ENCODINGS))
+    for layer in layers:
+        paths = glob.glob(os.path.join(output_dir, layer, "*.geojson"))
+        if not paths:
+            continue
+        raw = sum(os.path.getsize(path) for path in paths)
+        line = f"{layer:<16} {len(paths):>5} {raw / 1e6:9.2f}"
+        for ext in ENCODINGS:
+            size = sum(os.path.getsize(path + ext) if os.path.exists(path + ext) else os.path.getsize(path) for path in paths)
+            line += f" {size / 1e6:9.2f} {1 - size / raw:6.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate map layers from MILES_ptype_hrrr netcdfs")
+    parser.add_argument("--input-dir", default=".")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--layers", default=",".join(LAYERS), help="Comma separated subset of " + ",".join(LAYERS))
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--tiles", action="store_true", help="Also write vector tile pyramids")
+    parser.add_argument("--tile-dir", default=None, help="Defaults to <output-dir>/tiles")
+    parser.add_argument("--bundles", action="store_true", help="Also write one animation bundle per run and layer")
+    parser.add_argument("--size-report", action="store_true", help="Print raw vs precompressed sizes per layer")
+    parser.add_argument("--force", action="store_true", help="Regenerate even if outputs are up to date")
+    args = parser.parse_args()
+
+    layers = args.layers.split(",")
+    tile_dir = (args.tile_dir or os.path.join(args.output_dir, "tiles")) if args.tiles else None
+    fils = sorted(glob.glob(os.path.join(args.input_dir, "MILES_ptype_hrrr_*.nc")))
+
+    totals = {layer: [] for layer in layers}
+    loads = []
+    start = time.perf_counter()
+    with Pool(processes=args.processes) as pool:
+        for fil, timings, load_time, failed in pool.imap_unordered(process_file, [(fil, args.output_dir, tile_dir, layers, args.force) for fil in fils]):
+            if timings:
+                loads.append(load_time)
+                print(f"{os.path.basename(fil)}: {len(timings)} layers in {load_time + sum(timings.values()):.1f}s")
+            for layer, seconds in timings.items():
+                totals[layer].append(seconds)
+
+    # Per-layer timing summary
+    print(f"{len(fils)} files, {len(loads)} processed in {time.perf_counter() - start:.1f}s")
+    if loads:
+        print(f"{'load':<16} {len(loads):>5} files  mean {np.mean(loads):6.2f}s  total {np.sum(loads):7.1f}s")
+    for layer, seconds in totals.items():
+        if seconds:
+            print(f"{layer:<16} {len(seconds):>5} files  mean {np.mean(seconds):6.2f}s  total {np.sum(seconds):7.1f}s")
+
+    # Animation bundles, once every hour of each run is written
+    if args.bundles:
+        runs = {}
+        for fil in fils:
+            run, hour = run_name(fil).rsplit("_f", 1)
+            runs.setdefault(run, []).append(int(hour))
+        tasks = [(args.output_dir, layer, run, hours, args.force) for layer in layers for run, hours in runs.items()]
+        with Pool(processes=args.processes) as pool:
+            for layer, run, seconds, size, gz_size in pool.imap_unordered(process_bundle, tasks):
+                if seconds is not None:
+                    print(f"{os.path.basename(bundle_path(args.output_dir, layer, run))}: {size / 1e6:.2f} MB "
+                          f"(gzipped hours {gz_size / 1e6:.2f} MB) in {seconds:.1f}s")
+
+    if args.size_report:
+        size_report(args.output_dir, layers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import numpy as np
+
+# Mapbox vector tiles from the layer GeoJSONs
+#
+# Each layer/run becomes a z/x/y.pbf pyramid (Web Mercator, 4096 extent), simplified to about a pixel
+# per zoom level and clipped to each tile, so clients only fetch the geometry visible at their zoom.
+# Used by layers.py --tiles; served by the backend's /tiles route.
+#
+# Requires shapely and mapbox-vector-tile.
+
+# Web Mercator half-width of the world (m)
+EXTENT = 20037508.342789244
+
+# Tile resolution in pixels used for simplification tolerance and clip buffer
+TILE_PIXELS = 256
+BUFFER_PIXELS = 8
+
+
+def to_mercator(x, y):
+    """ Lon/lat (either -180/180 or 0/360) to Web Mercator meters """
+    lon = np.where(np.asarray(x) > 180, np.asarray(x) - 360, x)
+    lat = np.clip(y, -85.05, 85.05)
+    return EXTENT / 180 * lon, 6378137.0 * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+
+
+def same_dimension(geom, dim):
+    """ Drop the parts of geom (e.g. slivers left by make_valid or clipping) that are not of dimension dim """
+    import shapely
+
+    if geom.is_empty or (shapely.get_dimensions(geom) == dim and geom.geom_type != 'GeometryCollection'):
+        return geom
+    parts = [part for part in shapely.get_parts(geom) if shapely.get_dimensions(part) == dim]
+    return shapely.union_all(parts) if parts else shapely.GeometryCollection()
+
+
+def make_valid(geom):
+    """ Repair self-intersecting contour polygons (make_valid can fail on degenerate rings, buffer(0) does not) """
+    import shapely
+
+    try:
+        return shapely.make_valid(geom)
+    except shapely.errors.GEOSException:
+        return geom.buffer(0)
+
+
+def tile_bounds(z, x, y):
+    size = 2 * EXTENT / 2**z
+    return (-EXTENT + x * size, EXTENT - (y + 1) * size, -EXTENT + (x + 1) * size, EXTENT - y * size)
+
+
+def write_tiles(geojson_text, tile_dir, name, zooms=range(3, 9)):
+    """ Write a z/x/y.pbf pyramid for one GeoJSON layer.
+
+    Args:
+        geojson_text (str): GeoJSON FeatureCollection as written by layers.py
+        tile_dir (str): Directory to (re)create, e.g. tiles/<layer>/<run>
+        name (str): Layer name inside the tiles
+        zooms (iterable): Zoom levels to generate
+    Returns:
+        int: Number of tiles written
+    """
+    import mapbox_vector_tile
+    import shapely
+    from shapely.geometry import shape, box
+    from shapely.ops import transform
+
+    features = []
+    for feature in json.loads(geojson_text)['features']:
+        geom = shape(feature['geometry'])
+        if geom.is_empty:
+            continue
+        geom = transform(to_mercator, geom)
+        if not geom.is_valid:
+            geom = same_dimension(make_valid(geom), shapely.get_dimensions(geom))
+        if not geom.is_empty:
+            features.append((geom, feature['properties']))
+
+    # Build next to the old pyramid and swap at the end
+    tmp_dir = tile_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    count = 0
+    if features:
+        minx, miny, maxx, maxy = shapely.GeometryCollection([geom for geom, props in features]).bounds
+        for z in zooms:
+            size = 2 * EXTENT / 2**z
+            simplified = [(geom.simplify(size / TILE_PIXELS, preserve_topology=True), props) for geom, props in features]
+            buffer = size * BUFFER_PIXELS / TILE_PIXELS
+            for x in range(int((minx + EXTENT) // size), int((maxx + EXTENT) // size) + 1):
+                for y in range(int((EXTENT - maxy) // size), int((EXTENT - miny) // size) + 1):
+                    bounds = tile_bounds(z, x, y)
+                    clip = box(bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+                    clipped = [{"geometry": same_dimension(geom.intersection(clip), shapely.get_dimensions(geom)), "properties": props}
+                               for geom, props in simplified if geom.intersects(clip)]
+                    clipped = [feature for feature in clipped if not feature["geometry"].is_empty]
+                    if not clipped:
+                        continue
+                    data = mapbox_vector_tile.encode([{"name": name, "features": clipped}],
+                                                     default_options={"quantize_bounds": bounds, "extents": 4096})
+                    os.makedirs(os.path.join(tmp_dir, str(z), str(x)), exist_ok=True)
+                    with open(os.path.join(tmp_dir, str(z), str(x), f"{y}.pbf"), 'wb') as f:
+                        f.write(data)
+                    count += 1
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.replace(tmp_dir, tile_dir)
+    return count